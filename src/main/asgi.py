@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
+from django.urls import reverse
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'main.settings')
 
 application = get_asgi_application()
+if settings.DEBUG:
+    # Serve the admin's static files like runserver does
+    application = ASGIStaticFilesHandler(application)
+
+# Imported once the apps are loaded
+from slack_events.asgi import WebhookRouter  # noqa: E402
+
+application = WebhookRouter(application, reverse('xapi_slack'))
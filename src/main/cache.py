@@ -0,0 +1,77 @@
+from collections import OrderedDict
+import threading
+import time
+
+from django.core.cache import cache
+
+
+def get_version(version_key):
+    return cache.get(version_key, 0)
+
+
+def bump_version(version_key):
+    """ Increments a version stored in the Django cache, used to tell the
+    other processes sharing the cache that their local copies are stale """
+    try:
+        return cache.incr(version_key)
+    except ValueError:
+        cache.set(version_key, 1, timeout=None)
+        return 1
+
+
+class TTLCache:
+    """ Bounded in-process cache with a time to live per entry, the least
+    recently used entries are evicted first.
+
+    If a `version_key` is given the whole cache is cleared whenever that
+    version changes in the Django cache (see `bump_version`) """
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl, version_key=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version_key = version_key
+        self.version = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def check_version(self):
+        if not self.version_key:
+            return
+        version = get_version(self.version_key)
+        if version != self.version:
+            with self.lock:
+                self.entries.clear()
+                self.version = version
+
+    def get(self, key, default=MISSING):
+        self.check_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
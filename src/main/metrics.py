@@ -0,0 +1,260 @@
+from bisect import bisect_left
+from collections import Counter
+from contextlib import ContextDecorator
+import atexit
+import copy
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+_counters = Counter()
+_histograms = {}
+_written_at = 0
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The last count is of the values above the highest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def to_dict(self):
+        return {'buckets': self.buckets, 'counts': self.counts,
+                'sum': self.sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['buckets'])
+        histogram.counts = list(data['counts'])
+        histogram.sum = data['sum']
+        histogram.count = data['count']
+        return histogram
+
+
+def series_key(name, labels):
+    return (name, tuple(sorted((label, str(value))
+                               for label, value in labels.items())))
+
+
+def increment(name, value=1, **labels):
+    """ Increments a counter of this process, the labels distinguish the
+    series of the same counter """
+    with _lock:
+        _counters[series_key(name, labels)] += value
+    write_snapshot_if_due()
+
+
+def get_counter(name, **labels):
+    return _counters[series_key(name, labels)]
+
+
+def get_counters():
+    """ Returns a copy of all counters as {(name, labels): value} """
+    with _lock:
+        return dict(_counters)
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """ Adds a value (e.g. a latency in seconds) to a histogram of this
+    process """
+    key = series_key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+    write_snapshot_if_due()
+
+
+def get_histogram(name, **labels):
+    with _lock:
+        histogram = _histograms.get(series_key(name, labels))
+        return copy.deepcopy(histogram)
+
+
+class timer(ContextDecorator):
+    """ Observes the seconds spent within a block or decorated function in
+    a histogram """
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self.start = None
+        self.seconds = None
+
+    def _recreate_cm(self):
+        return copy.copy(self)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.perf_counter() - self.start
+        observe(self.name, self.seconds, **self.labels)
+        return False
+
+
+def snapshot_path():
+    # The processes of all containers sharing the data volume write to the
+    # same directory, the host name tells their pids apart
+    return os.path.join(settings.METRICS_DIR,
+                        f'{socket.gethostname()}-{os.getpid()}.json')
+
+
+def write_snapshot():
+    """ Writes the metrics of this process to its file in METRICS_DIR, where
+    they are aggregated with those of the other processes """
+    global _written_at
+    if not settings.METRICS_DIR:
+        return
+    with _lock:
+        _written_at = time.monotonic()
+        data = {
+            'counters': [[name, dict(labels), value]
+                         for (name, labels), value in _counters.items()],
+            'histograms': [[name, dict(labels), histogram.to_dict()]
+                           for (name, labels), histogram
+                           in _histograms.items()],
+        }
+    path = snapshot_path()
+    try:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump(data, file)
+        os.replace(f'{path}.tmp', path)
+    except OSError:
+        log.exception(f'Could not write the metrics to {path}')
+
+
+def write_snapshot_if_due():
+    if time.monotonic() - _written_at >= settings.METRICS_WRITE_INTERVAL:
+        write_snapshot()
+
+
+def read_snapshots(directory, stale_after):
+    """ Yields the name and the metrics of every process that wrote to the
+    directory. The files of processes that have not written for
+    `stale_after` seconds are removed, their process is most likely gone """
+    now = time.time()
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > stale_after:
+                os.remove(path)
+                continue
+            with open(path) as file:
+                yield name[:-len('.json')], json.load(file)
+        except (OSError, ValueError):
+            log.warning(f'Skipping unreadable metrics file {name}')
+
+
+def collect():
+    """ Returns the counters and histograms of all processes as
+    ({(name, labels): value}, {(name, labels): Histogram}).
+
+    Without METRICS_DIR only the metrics of this process are returned.
+    Otherwise every series is reported per process, with the host name and
+    pid of the process as its `process` label. Summed up, a restarted
+    process (that may reuse the host name and pid of a previous one) would
+    make the totals drop by what the other processes counted so far,
+    instead of resetting its own series like Prometheus expects. Use
+    sum without (process) (...) in the queries """
+    if not settings.METRICS_DIR:
+        with _lock:
+            return dict(_counters), copy.deepcopy(_histograms)
+
+    write_snapshot()
+    counters = {}
+    histograms = {}
+    for process, data in read_snapshots(settings.METRICS_DIR,
+                                        settings.METRICS_STALE_AFTER):
+        for name, labels, value in data['counters']:
+            counters[series_key(name, dict(labels, process=process))] = value
+        for name, labels, histogram_data in data['histograms']:
+            histograms[series_key(name, dict(labels, process=process))] = (
+                Histogram.from_dict(histogram_data))
+    return counters, histograms
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in labels) + '}'
+
+
+def render(counters, histograms):
+    """ Formats the metrics in the Prometheus text exposition format """
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (series, labels), value in sorted(counters.items()):
+            if series == name:
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {name} histogram')
+        for (series, labels), histogram in sorted(
+                histograms.items(), key=lambda item: item[0]):
+            if series != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket'
+                             f'{format_labels(labels, le=bound)} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} '
+                         f'{histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} '
+                         f'{histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def _reset_after_fork():
+    # A forked worker starts counting from zero under its own pid, the
+    # parent still reports what it counted before the fork
+    global _lock, _written_at
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+    _written_at = 0
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(write_snapshot)
@@ -0,0 +1,66 @@
+from contextlib import ContextDecorator
+import copy
+import logging
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from main import metrics
+
+log = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """ A stage made more database queries than its budget allows """
+
+
+class query_budget(ContextDecorator):
+    """ Counts the database queries made within a stage, as a context manager
+    or decorator. The count is added to the `db_queries_total` metric of the
+    stage and compared with its `budget`.
+
+    A stage over its budget is logged and counted in
+    `db_query_budget_exceeded_total`, with QUERY_BUDGETS_ENFORCED (or
+    `enforce=True`) it raises QueryBudgetExceeded instead. Nested stages
+    count towards the enclosing stages as well """
+
+    def __init__(self, stage, budget=None, enforce=None,
+                 using=DEFAULT_DB_ALIAS):
+        self.stage = stage
+        self.budget = budget
+        self.enforce = enforce
+        self.using = using
+        self.queries = 0
+
+    def _recreate_cm(self):
+        # Every call of a decorated function gets its own counter
+        return copy.copy(self)
+
+    def count(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.queries = 0
+        connections[self.using].execute_wrappers.append(self.count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connections[self.using].execute_wrappers.remove(self.count)
+        metrics.increment('db_queries_total', self.queries, stage=self.stage)
+        if exc_type is None:
+            self.check()
+        return False
+
+    def check(self):
+        if self.budget is None or self.queries <= self.budget:
+            return
+        metrics.increment('db_query_budget_exceeded_total', stage=self.stage)
+        message = (f'Stage {self.stage} made {self.queries} queries, its '
+                   f'budget is {self.budget}')
+        enforce = self.enforce
+        if enforce is None:
+            enforce = settings.QUERY_BUDGETS_ENFORCED
+        if enforce:
+            raise QueryBudgetExceeded(message)
+        log.warning(message)
@@ -91,6 +91,31 @@ DATABASES = {
 }
 
 CELERY_BROKER_URL = env('CELERY_BROKER_URL')
+CELERY_BEAT_SCHEDULE = {
+    'sweep-xapi-deliveries': {
+        'task': 'slack_events.tasks.sweep_xapi_deliveries',
+        'schedule': 60.0,
+    },
+}
+# Sync the actors with the Slack workspace every SLACK_USER_SYNC_INTERVAL
+# seconds, 0 disables the periodic sync (see manage.py sync_slack_users)
+SLACK_USER_SYNC_INTERVAL = env.int('SLACK_USER_SYNC_INTERVAL', default=0)
+if SLACK_USER_SYNC_INTERVAL:
+    CELERY_BEAT_SCHEDULE['sync-slack-users'] = {
+        'task': 'slack_events.tasks.sync_slack_users_task',
+        'schedule': float(SLACK_USER_SYNC_INTERVAL),
+    }
+
+# Use a shared cache (e.g. memcache:// or a filecache:// on the shared data
+# volume) so that state like the rule version is seen by all processes,
+# docker-compose.yml points all containers to its memcached
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# The compiled verb/object rules are recompiled at least every
+# XAPI_RULES_TTL seconds, in case a rule change was made in a process that
+# does not share the cache
+XAPI_RULES_TTL = env.int('XAPI_RULES_TTL', default=60)
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -134,4 +159,78 @@ STATIC_URL = '/static/'
 SLACK_OAUTH_TOKEN = env('SLACK_OAUTH_TOKEN')
 ACTOR_CREATION_ENABLED = env('ACTOR_CREATION_ENABLED') == 'True'
 ACTOR_IRI_TYPE = env('ACTOR_IRI_TYPE') or 'account'
+# Resolved actors are cached per process for ACTOR_CACHE_TTL seconds, Slack
+# users that cannot be resolved for ACTOR_NEGATIVE_CACHE_TTL seconds
+ACTOR_CACHE_SIZE = env.int('ACTOR_CACHE_SIZE', default=10000)
+ACTOR_CACHE_TTL = env.int('ACTOR_CACHE_TTL', default=3600)
+ACTOR_NEGATIVE_CACHE_TTL = env.int('ACTOR_NEGATIVE_CACHE_TTL', default=900)
 ENABLE_PERMALINKS = env('ENABLE_PERMALINKS') == 'True'
+# A Slack API call waits at most SLACK_API_MAX_WAIT seconds for its method to
+# be within Slack's rate limits again, otherwise it is given up or retried
+SLACK_API_MAX_WAIT = env.int('SLACK_API_MAX_WAIT', default=10)
+# Add the permalink as an extension to every object, otherwise permalinks
+# are only looked up for objects with `permalink` as their id field
+ENABLE_PERMALINK_EXTENSION = env(
+    'ENABLE_PERMALINK_EXTENSION', default='True') == 'True'
+# Drop events no verb and object rule can match in the webhook view
+SLACK_PREFILTER_ENABLED = env(
+    'SLACK_PREFILTER_ENABLED', default='True') == 'True'
+# Keep every received payload, including the ones no rule can match yet, in
+# the compressed raw event log for replays
+RAW_EVENT_LOG_ENABLED = env('RAW_EVENT_LOG_ENABLED', default='True') == 'True'
+# Slack retries events for up to about an hour, the event ids received in
+# the last SLACK_DEDUP_TTL seconds are used to drop those retries
+SLACK_DEDUP_TTL = env.int('SLACK_DEDUP_TTL', default=3600)
+SLACK_DEDUP_CACHE_SIZE = env.int('SLACK_DEDUP_CACHE_SIZE', default=50000)
+# The webhook view queues events in batches of at most SLACK_INGRESS_BATCH_SIZE
+# held back for at most SLACK_INGRESS_BATCH_MAX_DELAY milliseconds. Requests
+# are refused once SLACK_INGRESS_MAX_PENDING events wait to be queued
+SLACK_INGRESS_BATCHING = env(
+    'SLACK_INGRESS_BATCHING', default='True') == 'True'
+SLACK_INGRESS_BATCH_SIZE = env.int('SLACK_INGRESS_BATCH_SIZE', default=50)
+SLACK_INGRESS_BATCH_MAX_DELAY = env.int('SLACK_INGRESS_BATCH_MAX_DELAY',
+                                        default=200)
+SLACK_INGRESS_MAX_PENDING = env.int('SLACK_INGRESS_MAX_PENDING',
+                                    default=5000)
+# Events the broker cannot take are spooled to SLACK_SPOOL_DIR, the broker is
+# not tried again for SLACK_SPOOL_RETRY_INTERVAL seconds after a failure
+SLACK_SPOOL_DIR = env('SLACK_SPOOL_DIR', default=str(BASE_DIR / 'data/spool'))
+SLACK_SPOOL_SEGMENT_SIZE = env.int('SLACK_SPOOL_SEGMENT_SIZE',
+                                   default=16 * 1024 * 1024)
+SLACK_SPOOL_FSYNC_INTERVAL = env.int('SLACK_SPOOL_FSYNC_INTERVAL', default=50)
+SLACK_SPOOL_RETRY_INTERVAL = env.int('SLACK_SPOOL_RETRY_INTERVAL', default=5)
+SLACK_SPOOL_DRAIN_INTERVAL = env.int('SLACK_SPOOL_DRAIN_INTERVAL', default=30)
+# Open segments of a process that is gone are drained as well once they have
+# not been written to for SLACK_SPOOL_STALE_AFTER seconds
+SLACK_SPOOL_STALE_AFTER = env.int('SLACK_SPOOL_STALE_AFTER', default=600)
+CELERY_BEAT_SCHEDULE['drain-slack-spool'] = {
+    'task': 'slack_events.tasks.drain_slack_spool',
+    'schedule': float(SLACK_SPOOL_DRAIN_INTERVAL),
+}
+# Record when every event was received, queued and processed, how long each
+# stage took and how long it took to reach the LRS (see the Slack Event admin)
+SLACK_EVENT_TRACE_ENABLED = env(
+    'SLACK_EVENT_TRACE_ENABLED', default='True') == 'True'
+# Raise instead of logging a warning when a stage of the event tasks makes more
+# database queries than its budget allows
+QUERY_BUDGETS_ENFORCED = env(
+    'QUERY_BUDGETS_ENFORCED', default='False') == 'True'
+# Every process writes its metrics to METRICS_DIR at most every
+# METRICS_WRITE_INTERVAL seconds, the /metrics view reports them per process.
+# Without METRICS_DIR the view only reports the metrics of the web process.
+# The metrics of a process that has not written them for METRICS_STALE_AFTER
+# seconds are dropped
+METRICS_DIR = env('METRICS_DIR', default=str(BASE_DIR / 'data/metrics'))
+METRICS_WRITE_INTERVAL = env.int('METRICS_WRITE_INTERVAL', default=5)
+METRICS_STALE_AFTER = env.int('METRICS_STALE_AFTER', default=24 * 60 * 60)
+# Statements are sent to the LRS in batches of at most LRS_BATCH_SIZE and
+# held back for at most LRS_BATCH_MAX_AGE seconds
+LRS_BATCH_SIZE = env.int('LRS_BATCH_SIZE', default=50)
+LRS_BATCH_MAX_AGE = env.int('LRS_BATCH_MAX_AGE', default=5)
+LRS_FLUSH_MAX_BATCHES = env.int('LRS_FLUSH_MAX_BATCHES', default=20)
+# Deliveries that used up their retries are redelivered by the sweeper after
+# LRS_REDELIVERY_INTERVAL seconds, deliveries stuck in sending for
+# LRS_DELIVERY_STALE_AFTER seconds are assumed lost and queued again
+LRS_REDELIVERY_INTERVAL = env.int('LRS_REDELIVERY_INTERVAL', default=3600)
+LRS_DELIVERY_STALE_AFTER = env.int('LRS_DELIVERY_STALE_AFTER', default=1800)
+LRS_SWEEP_BATCH_SIZE = env.int('LRS_SWEEP_BATCH_SIZE', default=1000)
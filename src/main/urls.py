@@ -15,9 +15,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from main.views import metrics_view
 from slack_events.urls import urlpatterns as slack_urls
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('xapi/', include(slack_urls))
+    path('xapi/', include(slack_urls)),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,11 @@
+from django.http import HttpResponse
+
+from main import metrics
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def metrics_view(request):
+    """ Metrics of all processes in the Prometheus text format """
+    return HttpResponse(metrics.render(*metrics.collect()),
+                        content_type=CONTENT_TYPE)
@@ -1,13 +1,74 @@
 from django.contrib import admin
-from .models import RawSlackEvent, SlackEvent, XApiStatement
+from django.db.models import F
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
+from .models import RawSlackEvent, SlackEvent, XApiStatement, XApiDelivery
+
+
+class RawSlackEventAdmin(admin.ModelAdmin):
+    model = RawSlackEvent
+    list_display = ('__str__', 'first_sequence', 'event_count', 'created_at')
+
+
+class SlackEventAdmin(admin.ModelAdmin):
+    """ Lists the slowest events first, together with the step of their
+    trace that took the longest """
+    model = SlackEvent
+    list_display = ('__str__', 'event_id', 'received_at', 'latency',
+                    'slowest_step')
+    list_filter = ('event_type',)
+    search_fields = ('event_id',)
+    ordering = (F('latency').desc(nulls_last=True), '-pk')
+    readonly_fields = ('received_at', 'latency', 'trace_steps')
+
+    def slowest_step(self, obj):
+        durations = obj.trace_durations()
+        if not durations:
+            return None
+        step = max(durations, key=durations.get)
+        return f'{step} ({durations[step]:.3f}s)'
+
+    def trace_steps(self, obj):
+        """ The duration of every step and when the event reached each LRS,
+        relative to when it was received """
+        lines = [(step, f'{seconds:.3f}s')
+                 for step, seconds in obj.trace_durations().items()]
+        deliveries = XApiDelivery.objects.filter(
+            statement__slack_event=obj).select_related('lrs_config')
+        for delivery in deliveries:
+            if delivery.delivered_at and obj.received_at:
+                delay = delivery.delivered_at - obj.received_at
+                value = (f'{delay.total_seconds():.3f}s after it was received'
+                         f' ({delivery.attempts} attempts)')
+            else:
+                value = f'{delivery.status} ({delivery.attempts} attempts)'
+            lines.append((f'delivery to {delivery.lrs_config}', value))
+        return format_html_join(mark_safe('<br>'), '{}: {}', lines)
+
+
+class XApiDeliveryInline(admin.TabularInline):
+    model = XApiDelivery
+    fields = ('lrs_config', 'status', 'attempts', 'delivered_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
 
 
 class XApiStatementAdmin(admin.ModelAdmin):
     model = XApiStatement
     list_display = ('slack_event', 'delivered',)
     list_filter = ('slack_event', 'delivered',)
+    inlines = (XApiDeliveryInline,)
+
+
+class XApiDeliveryAdmin(admin.ModelAdmin):
+    model = XApiDelivery
+    list_display = ('statement', 'lrs_config', 'status', 'attempts',
+                    'delivered_at')
+    list_filter = ('lrs_config', 'status',)
 
 
-admin.site.register(RawSlackEvent)
-admin.site.register(SlackEvent)
+admin.site.register(RawSlackEvent, RawSlackEventAdmin)
+admin.site.register(SlackEvent, SlackEventAdmin)
 admin.site.register(XApiStatement, XApiStatementAdmin)
+admin.site.register(XApiDelivery, XApiDeliveryAdmin)
@@ -0,0 +1,135 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.db import close_old_connections
+
+log = logging.getLogger(__name__)
+
+
+class IngressBufferFull(Exception):
+    """ Too many events are waiting to be queued, the request should be
+    refused so that Slack delivers the event again later """
+
+
+class IngressAggregator:
+    """ Collects the envelopes received by a web process and publishes them
+    as one batch once `max_events` envelopes are waiting or the oldest has
+    waited for `max_delay` seconds.
+
+    `publish` is called with a list of envelopes by a thread of the
+    aggregator, so requests never wait on it. If it fails the envelopes are
+    kept and tried again after `max_delay`, but at most `max_pending`
+    envelopes are held in memory at any time """
+
+    def __init__(self, publish, max_events, max_delay, max_pending):
+        self.publish = publish
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.pending = []
+        self.oldest_at = None
+        self.retry_at = 0
+        self.thread = None
+
+    def add(self, envelope):
+        """ Adds an envelope to the next batch
+
+        Raises IngressBufferFull if the envelope cannot be held """
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                raise IngressBufferFull(
+                    f'{len(self.pending)} events are waiting to be queued')
+            if not self.pending:
+                self.oldest_at = time.monotonic()
+            self.pending.append(envelope)
+            self.start_thread()
+            if len(self.pending) >= self.max_events:
+                self.ready.notify()
+
+    def flush(self):
+        """ Publishes everything that is waiting, batch by batch, in the
+        calling thread """
+        while True:
+            with self.lock:
+                batch = self.take_batch()
+            if not batch or not self.publish_batch(batch):
+                return
+
+    def start_thread(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='ingress-aggregator')
+        self.thread.start()
+
+    def publish_at(self):
+        """ When the next batch is due, None if nothing is waiting """
+        if not self.pending:
+            return None
+        if len(self.pending) >= self.max_events:
+            return self.retry_at
+        return max(self.oldest_at + self.max_delay, self.retry_at)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while True:
+                    publish_at = self.publish_at()
+                    if publish_at is not None:
+                        remaining = publish_at - time.monotonic()
+                        if remaining <= 0:
+                            break
+                    else:
+                        remaining = None
+                    self.ready.wait(remaining)
+                batch = self.take_batch()
+            if not self.publish_batch(batch):
+                self.retry_at = time.monotonic() + self.max_delay
+            # Like a request, do not hold on to a database connection the
+            # publish function may have opened
+            close_old_connections()
+
+    def take_batch(self):
+        batch = self.pending[:self.max_events]
+        del self.pending[:self.max_events]
+        self.oldest_at = time.monotonic() if self.pending else None
+        return batch
+
+    def publish_batch(self, batch):
+        """ Returns if the batch was published, failed batches are put back
+        in front of the waiting envelopes """
+        try:
+            self.publish(batch)
+            return True
+        except Exception:
+            log.exception(f'Could not queue a batch of {len(batch)} events')
+
+        with self.lock:
+            self.pending[:0] = batch
+            self.oldest_at = self.oldest_at or time.monotonic()
+            dropped = self.pending[self.max_pending:]
+            del self.pending[self.max_pending:]
+        if dropped:
+            log.error(f'Dropping {len(dropped)} events, the ingress buffer '
+                      f'is full: '
+                      f'{", ".join(str(e.event_id) for e in dropped)}')
+        return False
+
+
+_aggregators = {}
+_aggregators_lock = threading.Lock()
+
+
+def get_aggregator(publish, max_events, max_delay, max_pending):
+    """ Returns the aggregator of this process for `publish`, creating it on
+    first use so that it is not shared with forked worker processes """
+    with _aggregators_lock:
+        if publish not in _aggregators:
+            _aggregators[publish] = IngressAggregator(
+                publish, max_events, max_delay, max_pending)
+            atexit.register(_aggregators[publish].flush)
+        return _aggregators[publish]
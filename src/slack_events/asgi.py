@@ -0,0 +1,60 @@
+import json
+import logging
+
+from .views import handle_webhook
+
+log = logging.getLogger(__name__)
+
+
+class WebhookRouter:
+    """ ASGI application answering the POST requests of the Slack webhook
+    at `path` straight away and passing everything else on to
+    `application`.
+
+    Every middleware of Django 3.1 runs its hooks in the one thread shared
+    by all sync code, so the requests would wait for each other there even
+    though the webhook needs none of them (no session, user or CSRF
+    token) """
+
+    def __init__(self, application, path):
+        self.application = application
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] != 'http' or scope['path'] != self.path
+                or scope['method'] != 'POST'):
+            return await self.application(scope, receive, send)
+
+        body = await read_body(receive)
+        if body is None:
+            return
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                   for name, value in scope.get('headers', [])}
+        try:
+            status, content = 200, await handle_webhook(
+                body, headers.get('x-slack-retry-num'))
+        except Exception:
+            # Slack delivers the event again
+            log.exception('Could not accept a Slack event')
+            status, content = 500, {'ok': False}
+
+        response = json.dumps(content).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(response)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': response})
+
+
+async def read_body(receive):
+    """ Returns the request body, or None if the client disconnected """
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
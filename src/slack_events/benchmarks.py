@@ -0,0 +1,358 @@
+import asyncio
+from contextlib import contextmanager
+import json
+import tempfile
+import time
+from unittest.mock import patch
+
+import requests
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from main.celery import app as celery_app
+from main.encrypt_decrypt import encrypt
+from xapi.actors import actor_cache
+from xapi.models import LrsConfig, XApiVerb, XApiObject
+from xapi.sessions import get_lrs_session, close_lrs_session
+from . import helper
+from .envelope import SlackEventEnvelope
+from .loadgen import generate_payloads, percentile
+from .models import SlackEvent, XApiStatement
+from .normalize import normalize_payloads
+from .slack_api import slack_client
+from .stubs import StubLrs, StubSlackApi, stub_slack_user
+from .tasks import schedule_xapi_batch_task, send_xapi_statements_to_lrs
+
+SEED_FIXTURE = settings.BASE_DIR.parent / 'seed' / 'xapi.json'
+LOCMEM_CACHE = 'django.core.cache.backends.locmem.LocMemCache'
+BASELINES = 'slack_events/benchmark_baselines.json'
+
+BENCHMARK_STATEMENT = {
+    'actor': {'name': 'Benchmark', 'mbox': 'mailto:benchmark@example.com'},
+    'verb': {'id': 'http://example.com/verbs/sent'},
+    'object': {'id': 'http://example.com/activities/message/Ev0'},
+}
+
+
+def timed(name, runs, func):
+    """ Runs `func` `runs` times and returns its throughput """
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    seconds = time.perf_counter() - start
+    return {'name': name, 'runs': runs, 'seconds': seconds,
+            'per_second': runs / seconds}
+
+
+def timed_variants(runs, variants, rounds=5):
+    """ Runs each of the (name, func) `variants` `runs` times in `rounds`
+    rounds, taking turns so that all variants run under the same load of
+    the machine, and returns their throughput in their fastest round.
+
+    `speedup` is the throughput of a variant relative to the first one.
+    Unlike the throughput it does not depend on the machine, which makes it
+    comparable with the baselines """
+    per_round = max(runs // rounds, 1)
+    results = {}
+    for _ in range(rounds):
+        for name, func in variants:
+            result = timed(name, per_round, func)
+            best = results.get(name)
+            if best:
+                result['runs'] += best['runs']
+                result['seconds'] += best['seconds']
+                result['per_second'] = max(result['per_second'],
+                                           best['per_second'])
+            results[name] = result
+    results = [results[name] for name, _ in variants]
+    for result in results:
+        result['speedup'] = result['per_second'] / results[0]['per_second']
+    return results
+
+
+def benchmark_lrs_delivery(runs=500):
+    """ Compares one connection and password decryption per request with
+    the pooled keep-alive session of an LrsConfig, against a stub LRS """
+    key = bytes(settings.SECRET_KEY, 'utf-8')
+    data = json.dumps([BENCHMARK_STATEMENT])
+
+    with StubLrs() as lrs:
+        lrs_config = LrsConfig(
+            pk=0, lrs_endpoint=lrs.url, lrs_auth_user='benchmark',
+            lrs_auth_pw=encrypt(key, b'password'))
+
+        def post_per_request():
+            requests.post(lrs_config.lrs_endpoint, data=data,
+                          auth=(lrs_config.lrs_auth_user,
+                                lrs_config.get_password()),
+                          headers={'Content-type': 'application/json',
+                                   'x-experience-api-version': '1.0.1'},
+                          timeout=3)
+
+        def post_pooled():
+            get_lrs_session(lrs_config).post(
+                lrs_config.lrs_endpoint, data=data, timeout=3)
+
+        try:
+            return timed_variants(runs, [
+                ('requests.post per statement', post_per_request),
+                ('pooled LRS session', post_pooled),
+            ])
+        finally:
+            close_lrs_session(lrs_config.pk)
+
+
+def benchmark_event_parsing(runs=500):
+    """ Compares decoding the payload in every stage of the pipeline (view,
+    task, save and permalink lookup) with the parse-once envelope, both
+    followed by the same normalization to a SlackEvent """
+    with open('slack_events/test_data/slack_event_tests.json') as file:
+        bodies = [json.dumps(payload).encode('utf-8')
+                  for payload in json.load(file)]
+
+    def decode_per_stage():
+        for body in bodies:
+            payload = json.loads(body)
+            slack_event = SlackEvent(_payload=json.dumps(payload))
+            slack_event.populate_from_payload()
+            json.loads(slack_event._payload).get('event')
+
+    def decode_once():
+        for body in bodies:
+            slack_event = SlackEvent.from_envelope(
+                SlackEventEnvelope.from_json(body))
+            slack_event.populate_from_payload()
+            slack_event.envelope.event
+
+    return timed_variants(runs, [
+        ('payload decoded per stage', decode_per_stage),
+        ('parse-once envelope', decode_once),
+    ])
+
+
+def benchmark_normalization(runs=500):
+    """ Normalizes the test payloads with and without a SlackEvent """
+    with open('slack_events/test_data/slack_event_tests.json') as file:
+        envelopes = [SlackEventEnvelope(payload)
+                     for payload in json.load(file)]
+
+    def populate_models():
+        for envelope in envelopes:
+            SlackEvent.from_envelope(envelope).populate_from_payload()
+
+    return timed_variants(runs, [
+        ('SlackEvent.populate_from_payload', populate_models),
+        ('normalize_payloads', lambda: normalize_payloads(envelopes)),
+    ])
+
+
+def benchmark_webhook_ack(runs=500, concurrency=200):
+    """ Sends `runs` Slack events to the ASGI application, `concurrency` of
+    them at a time, and measures how long each takes to be acknowledged.
+    The events are queued to a no-op broker and the prefilter is disabled,
+    so only the web process is measured """
+    with open('slack_events/test_data/slack_event_tests.json') as file:
+        payload = json.load(file)[0]
+    from main.asgi import application
+    latencies = []
+
+    async def post(index, semaphore):
+        body = json.dumps(dict(payload, event_id=f'EvLoad{index}'))
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': '/xapi/slack/', 'query_string': b'',
+            'headers': [(b'content-type', b'application/json'),
+                        (b'content-length', str(len(body)).encode())],
+            'server': ('localhost', 8000), 'client': ('127.0.0.1', 0),
+        }
+        async with semaphore:
+            start = time.perf_counter()
+            communicator = ApplicationCommunicator(application, scope)
+            await communicator.send_input({'type': 'http.request',
+                                           'body': body.encode('utf-8')})
+            response = await communicator.receive_output(timeout=30)
+            await communicator.receive_output(timeout=30)
+            latencies.append(time.perf_counter() - start)
+        assert response['status'] == 200, response
+
+    async def post_all():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*[post(index, semaphore)
+                               for index in range(runs)])
+
+    with tempfile.TemporaryDirectory() as spool_dir, \
+            override_settings(SLACK_PREFILTER_ENABLED=False,
+                              RAW_EVENT_LOG_ENABLED=False,
+                              SLACK_SPOOL_DIR=spool_dir,
+                              ALLOWED_HOSTS=['localhost']), \
+            patch('slack_events.ingress.schedule_xapi_batch_task'):
+        start = time.perf_counter()
+        asyncio.run(post_all())
+        seconds = time.perf_counter() - start
+
+    return [{
+        'name': f'webhook ack ({concurrency} concurrent)', 'runs': runs,
+        'seconds': seconds, 'per_second': runs / seconds,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }]
+
+
+@contextmanager
+def pipeline_environment(lrs, slack_api):
+    """ Runs the pipeline against a throwaway test database seeded with the
+    rules of seed/xapi.json, a local cache, the stub Slack API and a stub
+    LRS, with Celery tasks executed in place """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                       serialize=False)
+    old_eager = celery_app.conf.task_always_eager
+    celery_app.conf.task_always_eager = True
+    old_base_url = slack_client.base_url
+    slack_client.base_url = slack_api.api_url
+    try:
+        with override_settings(
+                CACHES={'default': {'BACKEND': LOCMEM_CACHE}},
+                ACTOR_CREATION_ENABLED=True, ENABLE_PERMALINKS=True,
+                RAW_EVENT_LOG_ENABLED=True):
+            call_command('loaddata', SEED_FIXTURE, verbosity=0)
+            LrsConfig.objects.create(
+                display_name='Benchmark LRS', lrs_endpoint=lrs.url,
+                lrs_auth_user='benchmark', lrs_auth_pw='password')
+            actor_cache.clear()
+            helper._team_domains.clear()
+            yield
+    finally:
+        slack_client.base_url = old_base_url
+        celery_app.conf.task_always_eager = old_eager
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def timed_stage(name, func, events):
+    """ Runs a pipeline stage once over all events and returns its
+    throughput together with the number of queries it made """
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    return {'name': name, 'runs': len(events), 'seconds': seconds,
+            'per_second': len(events) / seconds,
+            'queries': len(queries.captured_queries)}
+
+
+def benchmark_pipeline(runs=500):
+    """ Measures each stage of the pipeline over a corpus of `runs` test and
+    synthetic events, and the batch task end to end (including the
+    delivery to the stub LRS) over another corpus of the same size """
+    user_ids = ('U123456', 'U01AP5SU5QB', 'U9876543')
+    slack_api = StubSlackApi(users=[
+        stub_slack_user(user_id, email=f'{user_id.lower()}@example.com')
+        for user_id in user_ids])
+    lrs = StubLrs()
+    results = []
+
+    with slack_api, lrs, pipeline_environment(lrs, slack_api):
+        payloads = list(generate_payloads(runs, run_id=1))
+        slack_events = []
+        statements = []
+
+        def normalize():
+            for payload in payloads:
+                slack_event = SlackEvent.from_envelope(
+                    SlackEventEnvelope.from_json(payload))
+                slack_event.populate_from_payload()
+                slack_events.append(slack_event)
+
+        def save():
+            for slack_event in slack_events:
+                slack_event.save()
+
+        def match():
+            for slack_event in slack_events:
+                XApiVerb.slack_event_to_xapi_verb(slack_event)
+                XApiObject.match_slack_event(slack_event)
+
+        def build():
+            for slack_event in slack_events:
+                statement = slack_event.build_xapi_statement()
+                if statement:
+                    statements.append(XApiStatement(statement=statement))
+
+        def deliver():
+            lrs_config = LrsConfig.objects.get()
+            for start in range(0, len(statements), settings.LRS_BATCH_SIZE):
+                send_xapi_statements_to_lrs(
+                    lrs_config,
+                    statements[start:start + settings.LRS_BATCH_SIZE])
+
+        for name, func in (('decode and normalize', normalize),
+                           ('save events', save),
+                           ('match rules', match),
+                           ('build statements', build),
+                           ('deliver to LRS', deliver)):
+            results.append(timed_stage(name, func, payloads))
+
+        batch = list(generate_payloads(runs, run_id=2))
+
+        def batch_task():
+            for start in range(0, len(batch),
+                               settings.SLACK_INGRESS_BATCH_SIZE):
+                schedule_xapi_batch_task(
+                    batch[start:start + settings.SLACK_INGRESS_BATCH_SIZE])
+
+        results.append(timed_stage('batch task end to end', batch_task,
+                                   batch))
+        close_lrs_session(LrsConfig.objects.get().pk)
+    return results
+
+
+def compare_with_baselines(benchmark, results, baselines, tolerance):
+    """ Compares results with the stored baselines of a benchmark
+
+    Returns a description of every result whose speedup over the first
+    variant of its run dropped below its baseline by more than the factor
+    `tolerance`, or that made more queries. The throughput depends on the
+    machine and its load and is not compared """
+    regressions = []
+    for result in results:
+        baseline = baselines.get(benchmark, {}).get(result['name'])
+        if not baseline:
+            continue
+        if ('speedup' in result and 'speedup' in baseline
+                and result['speedup'] * tolerance < baseline['speedup']):
+            regressions.append(
+                f'{benchmark}: {result["name"]} runs '
+                f'{result["speedup"]:.2f}x as fast as {results[0]["name"]}, '
+                f'baseline {baseline["speedup"]:.2f}x')
+        if result.get('queries', 0) > baseline.get('queries', 0):
+            regressions.append(
+                f'{benchmark}: {result["name"]} made {result["queries"]} '
+                f'queries, baseline {baseline["queries"]}')
+    return regressions
+
+
+def load_baselines(path=BASELINES):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(baselines, path=BASELINES):
+    with open(path, 'w') as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write('\n')
+
+
+BENCHMARKS = {
+    'lrs_delivery': benchmark_lrs_delivery,
+    'event_parsing': benchmark_event_parsing,
+    'normalization': benchmark_normalization,
+    'webhook_ack': benchmark_webhook_ack,
+    'pipeline': benchmark_pipeline,
+}
@@ -0,0 +1,58 @@
+import json
+
+
+class SlackEventEnvelope:
+    """ A Slack Events API payload decoded once when it is received and then
+    shared read-only by the ingress checks, the normalization to a
+    SlackEvent and the permalink helpers.
+
+    The serialized form is the request body the payload was decoded from,
+    so it only has to be encoded if the envelope was built from a dict.
+    Envelopes of webhook requests know when they were received """
+    __slots__ = ('payload', 'event', 'event_id', 'event_type',
+                 'event_subtype', 'team_id', 'received_at', '_serialized')
+
+    def __init__(self, payload, serialized=None, received_at=None):
+        event = payload.get('event') or {}
+        event_subtype = event.get('subtype')
+        if event.get('item'):
+            event_subtype = event.get('item').get('type')
+
+        set_attribute = super().__setattr__
+        set_attribute('payload', payload)
+        set_attribute('event', event)
+        set_attribute('event_id', payload.get('event_id'))
+        set_attribute('event_type', event.get('type'))
+        set_attribute('event_subtype', event_subtype)
+        set_attribute('team_id', payload.get('team_id'))
+        set_attribute('received_at', received_at)
+        set_attribute('_serialized', serialized)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __repr__(self):
+        return f'<SlackEventEnvelope {self.event_id} {self.event_type}>'
+
+    @classmethod
+    def from_json(cls, serialized, received_at=None):
+        """ Decodes a request body or stored payload """
+        if isinstance(serialized, bytes):
+            serialized = serialized.decode('utf-8')
+        return cls(json.loads(serialized), serialized, received_at)
+
+    @property
+    def serialized(self):
+        if self._serialized is None:
+            super().__setattr__('_serialized', json.dumps(self.payload))
+        return self._serialized
+
+
+def to_envelope(payload):
+    """ Accepts an envelope, its serialized form or a decoded payload, so
+    that tasks queued before the envelope existed are still handled """
+    if isinstance(payload, SlackEventEnvelope):
+        return payload
+    if isinstance(payload, (str, bytes)):
+        return SlackEventEnvelope.from_json(payload)
+    return SlackEventEnvelope(payload)
@@ -1,12 +1,72 @@
-import json
 import logging
 
-from django.conf import settings
+from django.core.cache import cache
 
-from slack import WebClient
+from slack.errors import SlackApiError
+
+from .slack_api import slack_client
 
 log = logging.getLogger(__name__)
-slack_client = WebClient(token=settings.SLACK_OAUTH_TOKEN)
+TEAM_DOMAIN_TIMEOUT = 60 * 60 * 24
+_team_domains = {}
+
+
+def call_slack_api(method, **kwargs):
+    """ Calls a method of the shared Slack client. Failed calls, including
+    calls that stayed rate limited for too long, are logged and return None
+    so that the event is handled without what they would have returned """
+    try:
+        response = getattr(slack_client, method)(**kwargs)
+    except SlackApiError as error:
+        log.warning(f'Slack API call {method} failed: {error}')
+        return None
+    if not response.get('ok'):
+        log.warning(f'Slack API call {method} failed: '
+                    f'{response.get("error")}')
+        return None
+    return response
+
+
+def get_team_domain(team_id):
+    """ Returns the workspace domain of a team, only calling team.info the
+    first time a team is seen """
+    if team_id in _team_domains:
+        return _team_domains[team_id]
+
+    cache_key = f'slack:team_domain:{team_id}'
+    domain = cache.get(cache_key)
+    if not domain:
+        team_info = call_slack_api('team_info', team=team_id)
+        if not team_info:
+            return
+        domain = (team_info.get('team', {}).get('domain') or
+                  team_info.get('team', {}).get('name'))
+        if not domain:
+            return
+        cache.set(cache_key, domain, timeout=TEAM_DOMAIN_TIMEOUT)
+
+    _team_domains[team_id] = domain
+    return domain
+
+
+def build_message_permalink(domain, channel, message_ts, thread_ts=None):
+    """ Builds the permalink of a message the same way chat.getPermalink
+    does, replies in a thread link to the message within the thread """
+    permalink = (f'https://{domain}.slack.com/archives/{channel}/'
+                 f'p{message_ts.replace(".", "")}')
+    if thread_ts and thread_ts != message_ts:
+        permalink += f'?thread_ts={thread_ts}&cid={channel}'
+    return permalink
+
+
+def get_api_message_permalink(channel, message_ts):
+    """ Retrieves the permalink for a Slack message through the API, for
+    messages whose permalink cannot be built locally """
+    permalink = call_slack_api('chat_getPermalink', channel=channel,
+                               message_ts=message_ts)
+    if not permalink:
+        return
+    return permalink.get('permalink')
 
 
 def get_file_permalink(slack_event):
@@ -16,41 +76,31 @@ def get_file_permalink(slack_event):
         return
 
     file_id = slack_event.file_ids[0]
-    file_info = slack_client.files_info(file=file_id)
-
-    if not file_info.get('ok'):
-        log.exception(file_info.get('error'))
+    file_info = call_slack_api('files_info', file=file_id)
+    if not file_info:
         return
     return (file_info.get('file', {}).get('permalink')
             or file_info.get('file', {}).get('url_private'))
 
 
 def get_channel_permalink(slack_event):
-    """ Retrieves the team info and constructs a permalink to the
-    Slack channel
+    """ Constructs a permalink to the Slack channel from the cached domain
+    of the workspace
 
     Returns the Slack channel permalink """
     if not slack_event.channel:
         log.exception("No channel id found.")
         return
 
-    team_info = slack_client.team_info(team=slack_event.team_id)
-    if not team_info.get('ok'):
-        log.exception(team_info.get('error'))
+    domain = get_team_domain(slack_event.team_id)
+    if not domain:
         return
-
-    domain = (team_info.get('team', {}).get('domain') or
-              team_info.get('team', {}).get('name'))
     return f'https://{domain}.slack.com/archives/{slack_event.channel}'
 
 
 def get_message_permalink(slack_event):
-    """ Retrieves the permalink for a Slack message """
-    event_content = json.loads(slack_event._payload).get('event')
-    message_ts = (event_content.get('item', {}).get('event_ts')
-                  or event_content.get('message', {}).get('event_ts')
-                  or event_content.get('ts')
-                  or event_content.get('event_ts'))
+    """ Constructs the permalink for a Slack message """
+    event_content = slack_event.envelope.event
 
     if event_content.get('item'):
         message_ts = event_content.get('item', {}).get('event_ts')
@@ -63,36 +113,32 @@ def get_message_permalink(slack_event):
     if not slack_event.channel or not message_ts:
         return
 
-    permalink = slack_client.chat_getPermalink(
-        channel=slack_event.channel, message_ts=message_ts)
-
-    if not permalink.get('ok'):
-        log.exception(permalink.get('error'))
-        return
-    return permalink.get('permalink')
+    thread_ts = (event_content.get('thread_ts')
+                 or event_content.get('message', {}).get('thread_ts'))
+    domain = get_team_domain(slack_event.team_id)
+    if domain:
+        return build_message_permalink(domain, slack_event.channel,
+                                       message_ts, thread_ts)
+    return get_api_message_permalink(slack_event.channel, message_ts)
 
 
 def get_reaction_permalink(slack_event):
-    """ Retrieves the permalink to the message a reaction was posted """
-    payload = json.loads(slack_event._payload)
-    item = payload.get('event', {}).get('item')
+    """ Constructs the permalink to the message a reaction was posted """
+    item = slack_event.envelope.event.get('item')
     if not item:
         log.info('No item found')
         return
 
-    permalink = slack_client.chat_getPermalink(
-        channel=item.get('channel'), message_ts=item.get('ts'))
-
-    if not permalink.get('ok'):
-        log.exception(permalink.get('error'))
-        return
-    return permalink.get('permalink')
+    domain = get_team_domain(slack_event.team_id)
+    if domain and item.get('channel') and item.get('ts'):
+        return build_message_permalink(domain, item.get('channel'),
+                                       item.get('ts'))
+    return get_api_message_permalink(item.get('channel'), item.get('ts'))
 
 
 def get_star_or_pin_permalink(slack_event):
     """ Retrieves the permalink to the message starred or pinned """
-    payload = json.loads(slack_event._payload)
-    message = payload.get('event', {}).get('item', {}).get('message')
+    message = slack_event.envelope.event.get('item', {}).get('message')
     if not message:
         log.info('No message found')
         return
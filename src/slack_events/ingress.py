@@ -0,0 +1,170 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from main import metrics
+from main.cache import TTLCache
+from xapi.rules import get_matcher
+from .aggregator import IngressBufferFull, get_aggregator
+from .raw_log import append_raw_events
+from .spool import get_spool
+from .tasks import schedule_xapi_batch_task
+
+log = logging.getLogger(__name__)
+SEEN_EVENT_KEY = 'slack:event:seen:{}'
+
+_broker_retry_at = 0
+
+recent_event_ids = TTLCache(maxsize=settings.SLACK_DEDUP_CACHE_SIZE,
+                            ttl=settings.SLACK_DEDUP_TTL)
+
+
+def is_duplicate_event(event_id):
+    """ Checks if an event has already been received and marks it as
+    received otherwise. Slack redelivers events whenever it did not get a
+    response fast enough, the redeliveries keep the same event_id.
+
+    The ids are kept in a bounded set in this process and in the Django
+    cache, so a redelivery to another web process is caught if the cache
+    is shared """
+    if not event_id:
+        return False
+    if recent_event_ids.get(event_id, False):
+        return True
+    recent_event_ids.set(event_id, True)
+    return not cache.add(SEEN_EVENT_KEY.format(event_id), True,
+                         timeout=settings.SLACK_DEDUP_TTL)
+
+
+def forget_event(event_id):
+    """ Removes an event from the received events, e.g. if it could not be
+    queued, so that Slack's redelivery is not dropped """
+    if not event_id:
+        return
+    recent_event_ids.delete(event_id)
+    cache.delete(SEEN_EVENT_KEY.format(event_id))
+
+
+def can_produce_statement(envelope):
+    """ Checks if any verb and object rule could match the event, so that
+    events which can never become a statement are dropped before they are
+    queued and stored """
+    if not settings.SLACK_PREFILTER_ENABLED:
+        return True
+    event_type = envelope.event_type
+    event_subtype = envelope.event_subtype
+    if (get_matcher('verb').can_match(event_type, event_subtype)
+            and get_matcher('object').can_match(event_type, event_subtype)):
+        return True
+    metrics.increment('slack_events_dropped_total', event_type=event_type,
+                      reason='no_matching_rule')
+    log.debug(f'Dropping {event_type} {event_subtype or ""} event, no rule '
+              f'can match it')
+    return False
+
+
+def queue_trace(envelopes):
+    """ The times a batch was received and queued at, passed on to the task
+    for the traces of its events """
+    if not settings.SLACK_EVENT_TRACE_ENABLED:
+        return None
+    return {
+        'received_at': {envelope.event_id: envelope.received_at
+                        for envelope in envelopes if envelope.event_id},
+        'enqueued_at': time.time(),
+    }
+
+
+def publish_events(envelopes):
+    """ Queues a batch of events, or spools them if the broker cannot take
+    them. After a failure the broker is not tried again for
+    SLACK_SPOOL_RETRY_INTERVAL seconds, so requests do not wait on it """
+    global _broker_retry_at
+    payloads = [envelope.serialized for envelope in envelopes]
+    if time.monotonic() >= _broker_retry_at:
+        try:
+            with metrics.timer('slack_broker_publish_seconds'):
+                schedule_xapi_batch_task.apply_async(
+                    (payloads,), {'trace': queue_trace(envelopes)},
+                    retry=False)
+            metrics.increment('slack_events_queued_total', len(payloads))
+            # Anything spooled during the outage can be drained now
+            get_spool().seal()
+            return
+        except Exception as error:
+            log.warning(f'Broker unavailable, spooling events: {error}')
+            _broker_retry_at = (time.monotonic()
+                                + settings.SLACK_SPOOL_RETRY_INTERVAL)
+    get_spool().append(payloads)
+    metrics.increment('slack_events_spooled_total', len(payloads))
+
+
+def enqueue_event(envelope):
+    """ Queues an event for the conversion to xAPI. Unless disabled the
+    events received by this process are collected and queued in batches,
+    so the broker sees one message per batch instead of per event
+
+    Raises IngressBufferFull if too many events are waiting already """
+    if not settings.SLACK_INGRESS_BATCHING:
+        publish_events([envelope])
+        return
+    get_aggregator(
+        publish_events,
+        max_events=settings.SLACK_INGRESS_BATCH_SIZE,
+        max_delay=settings.SLACK_INGRESS_BATCH_MAX_DELAY / 1000,
+        max_pending=settings.SLACK_INGRESS_MAX_PENDING,
+    ).add(envelope)
+
+
+def log_raw_events(envelopes):
+    append_raw_events([envelope.serialized for envelope in envelopes])
+
+
+def record_raw_event(envelope):
+    """ Adds an event to the raw event log, whether or not it can become a
+    statement with the current rules, so that it can be mapped again once
+    they change. Like the queued events the logged ones are written in
+    batches, by an aggregator of their own """
+    if not settings.RAW_EVENT_LOG_ENABLED:
+        return
+    if not settings.SLACK_INGRESS_BATCHING:
+        log_raw_events([envelope])
+        return
+    try:
+        get_aggregator(
+            log_raw_events,
+            max_events=settings.SLACK_INGRESS_BATCH_SIZE,
+            max_delay=settings.SLACK_INGRESS_BATCH_MAX_DELAY / 1000,
+            max_pending=settings.SLACK_INGRESS_MAX_PENDING,
+        ).add(envelope)
+    except IngressBufferFull as error:
+        # The event itself can still be queued
+        log.error(f'Not logging raw event {envelope.event_id}: {error}')
+        metrics.increment('raw_events_dropped_total')
+
+
+def accept_event(envelope, retry_num=None):
+    """ Runs the ingress checks on an event, adds it to the raw event log
+    unless it is a duplicate and queues it if it passes the prefilter
+
+    Returns False if the event was dropped by the prefilter or as a
+    duplicate """
+    event_id = envelope.event_id
+    if is_duplicate_event(event_id):
+        log.info(f'Dropping duplicate event {event_id} (retry {retry_num})')
+        metrics.increment('slack_events_dropped_total',
+                          event_type=envelope.event_type, reason='duplicate')
+        return False
+    record_raw_event(envelope)
+
+    if not can_produce_statement(envelope):
+        return False
+    try:
+        with metrics.timer('slack_enqueue_seconds'):
+            enqueue_event(envelope)
+    except Exception:
+        forget_event(event_id)
+        raise
+    return True
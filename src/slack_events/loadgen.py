@@ -0,0 +1,179 @@
+import asyncio
+import copy
+from collections import Counter
+import json
+import re
+import time
+
+import aiohttp
+
+
+TEST_DATA = 'slack_events/test_data/slack_event_tests.json'
+KINDS = ('message', 'reaction', 'file_share', 'edit', 'test_data')
+
+
+class LoadError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def load_templates(path=TEST_DATA):
+    """ Returns the payloads of the test data and a template per kind of
+    synthetic event derived from them """
+    with open(path) as file:
+        payloads = json.load(file)
+    message, reaction, edit = payloads[:3]
+    file_share = copy.deepcopy(message)
+    file_share['event'].update({
+        'subtype': 'file_share',
+        'text': 'Sharing a file',
+        'files': [{'id': 'F0LOAD', 'name': 'load.txt',
+                   'permalink': 'https://example.slack.com/files/F0LOAD'}],
+    })
+    return payloads, {'message': message, 'reaction': reaction,
+                      'file_share': file_share, 'edit': edit}
+
+
+def generate_payloads(count, kinds=KINDS, run_id=None, path=TEST_DATA):
+    """ Yields `count` serialized payloads cycling through `kinds`. Every
+    payload gets a unique event_id (so it is not dropped as a redelivery)
+    and the current time as its timestamps """
+    run_id = run_id or int(time.time())
+    test_payloads, templates = load_templates(path)
+    sources = []
+    for kind in kinds:
+        if kind == 'test_data':
+            sources.extend(test_payloads)
+        else:
+            sources.append(templates[kind])
+
+    for index in range(count):
+        payload = copy.deepcopy(sources[index % len(sources)])
+        now = time.time()
+        ts = f'{now:.6f}'
+        payload['event_id'] = event_id(run_id, index)
+        payload['event_time'] = int(now)
+        event = payload['event']
+        for field in ('ts', 'event_ts'):
+            if field in event:
+                event[field] = ts
+        if isinstance(event.get('message'), dict):
+            event['message']['ts'] = ts
+        yield json.dumps(payload)
+
+
+def event_id(run_id, index):
+    return f'EvLoad{run_id}x{index:08d}'
+
+
+def find_event_ids(statement, run_id):
+    """ Returns the load test event ids mentioned in a statement """
+    return re.findall(f'EvLoad{run_id}x[0-9]{{8}}', json.dumps(statement))
+
+
+class LoadResults:
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+        self.sent_at = {}
+        self.seconds = 0
+
+    @property
+    def sent(self):
+        return len(self.latencies)
+
+    def summary(self):
+        summary = {
+            'sent': self.sent,
+            'errors': sum(self.errors.values()),
+            'per_second': self.sent / self.seconds if self.seconds else 0,
+        }
+        if self.latencies:
+            for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                   ('p99', 0.99), ('max', 1)):
+                summary[name] = percentile(self.latencies, fraction)
+        return summary
+
+
+async def run_load(send, payloads, rate=0, concurrency=10):
+    """ Sends the payloads with the coroutine `send`, at most `concurrency`
+    at a time. With a `rate` (events per second) the payloads are sent on
+    a fixed schedule whether or not earlier ones have been answered yet,
+    and their latency counts from the scheduled send time, including the
+    time spent waiting for one of the `concurrency` slots. So a slow server
+    shows up as growing latency instead of a lower rate. Without a rate the
+    latency is that of the request alone """
+    results = LoadResults()
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_event_loop()
+
+    async def send_one(payload, scheduled_at=None):
+        async with semaphore:
+            if scheduled_at is None:
+                scheduled_at = (time.time(), time.perf_counter())
+            sent_at, start = scheduled_at
+            results.sent_at[json.loads(payload)['event_id']] = sent_at
+            try:
+                await send(payload)
+            except Exception as error:
+                results.errors[str(error) or type(error).__name__] += 1
+            results.latencies.append(time.perf_counter() - start)
+
+    start = loop.time()
+    pending = []
+    for index, payload in enumerate(payloads):
+        scheduled_at = None
+        if rate:
+            delay = start + index / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Before waiting for the semaphore, see send_one
+            scheduled_at = (time.time(), time.perf_counter())
+        pending.append(asyncio.ensure_future(send_one(payload, scheduled_at)))
+    await asyncio.gather(*pending)
+    results.seconds = loop.time() - start
+    return results
+
+
+def http_sender(session, url):
+    async def send(payload):
+        async with session.post(
+                url, data=payload,
+                headers={'Content-Type': 'application/json'}) as response:
+            await response.read()
+            if response.status != 200:
+                raise LoadError(f'HTTP {response.status}')
+    return send
+
+
+async def run_http_load(url, payloads, rate=0, concurrency=10, timeout=30):
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        return await run_load(http_sender(session, url), payloads, rate,
+                              concurrency)
+
+
+def task_sender(task):
+    """ Queues every payload as its own task, without the web process """
+    async def send(payload):
+        await asyncio.get_event_loop().run_in_executor(None, task.delay,
+                                                       payload)
+    return send
+
+
+def end_to_end_latencies(results, lrs, run_id):
+    """ Matches the statements received by a stub LRS to the sent events
+
+    Returns the latencies of the delivered events """
+    latencies = {}
+    for received_at, statement in list(lrs.statements):
+        for sent_id in find_event_ids(statement, run_id):
+            if sent_id in results.sent_at and sent_id not in latencies:
+                latencies[sent_id] = received_at - results.sent_at[sent_id]
+    return list(latencies.values())
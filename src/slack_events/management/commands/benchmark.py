@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from slack_events.benchmarks import (BENCHMARKS, compare_with_baselines,
+                                     load_baselines, save_baselines)
+
+
+class Command(BaseCommand):
+    help = 'Runs the offline benchmarks of the Slack to xAPI pipeline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmarks', nargs='*',
+                            choices=list(BENCHMARKS) + [[]],
+                            help='Benchmarks to run (default: all)')
+        parser.add_argument('--runs', type=int, default=500,
+                            help='Number of runs per benchmark')
+        parser.add_argument('--compare', action='store_true',
+                            help='Fail if a variant lost speedup against '
+                                 'its stored baseline or a result makes '
+                                 'more queries')
+        parser.add_argument('--tolerance', type=float, default=1.5,
+                            help='Factor the speedup of a variant may be '
+                                 'below its baseline by')
+        parser.add_argument('--save-baselines', action='store_true',
+                            help='Store the results as the new baselines')
+
+    def handle(self, *args, **options):
+        baselines = load_baselines()
+        regressions = []
+        for name in options['benchmarks'] or BENCHMARKS:
+            self.stdout.write(f'{name}:')
+            results = BENCHMARKS[name](runs=options['runs'])
+            for result in results:
+                line = (f'  {result["name"]:<40} {result["runs"]:>7} runs '
+                        f'{result["seconds"]:>8.3f}s '
+                        f'{result["per_second"]:>10.1f}/s')
+                if 'speedup' in result:
+                    line += f' {result["speedup"]:>6.2f}x'
+                if 'queries' in result:
+                    line += f' {result["queries"]:>7} queries'
+                if 'p99' in result:
+                    line += (f'  p50 {result["p50"] * 1000:.1f}ms'
+                             f'  p99 {result["p99"] * 1000:.1f}ms')
+                self.stdout.write(line)
+
+            if options['compare']:
+                regressions += compare_with_baselines(
+                    name, results, baselines, options['tolerance'])
+            if options['save_baselines']:
+                baselines[name] = {
+                    result['name']: {
+                        key: result[key] for key in
+                        ('runs', 'per_second', 'speedup', 'queries')
+                        if key in result}
+                    for result in results}
+
+        if options['save_baselines']:
+            save_baselines(baselines)
+        if regressions:
+            raise CommandError('Regressions against the baselines:\n'
+                               + '\n'.join(regressions))
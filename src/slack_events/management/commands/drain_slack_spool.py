@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from slack_events.spool import drain_spool
+from slack_events.tasks import schedule_xapi_batch_task
+
+
+class Command(BaseCommand):
+    help = ('Queues the Slack events spooled while the broker was '
+            'unavailable')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stale-after', type=int,
+                            default=settings.SLACK_SPOOL_STALE_AFTER,
+                            help='Also drain open segments not written to '
+                                 'for this many seconds')
+
+    def handle(self, *args, **options):
+        drained = drain_spool(
+            schedule_xapi_batch_task.delay, settings.SLACK_SPOOL_DIR,
+            batch_size=settings.SLACK_INGRESS_BATCH_SIZE,
+            stale_after=options['stale_after'])
+        self.stdout.write(f'Queued {drained} spooled events')
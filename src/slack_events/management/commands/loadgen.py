@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+
+from slack_events import loadgen
+from slack_events.loadgen import percentile
+from slack_events.stubs import StubLrs
+from slack_events.tasks import schedule_xapi_task
+from xapi.models import LrsConfig
+
+
+class Command(BaseCommand):
+    help = ('Replays test and synthetic Slack events against the webhook or '
+            'the task queue at a target rate and reports the latencies')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['http', 'tasks'],
+                            default='http',
+                            help='Post to the webhook or queue the tasks')
+        parser.add_argument('--url',
+                            default='http://localhost:8000/xapi/slack/',
+                            help='Webhook URL for the http target')
+        parser.add_argument('--events', type=int, default=1000,
+                            help='Number of events to send')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Events per second (default: as fast as '
+                                 'possible)')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Maximum number of events in flight')
+        parser.add_argument('--kinds', nargs='+', choices=loadgen.KINDS,
+                            default=list(loadgen.KINDS),
+                            help='Kinds of events to cycle through')
+        parser.add_argument('--stub-lrs-port', type=int, default=None,
+                            help='Start a stub LRS on this port and register '
+                                 'it as an active LRS for the duration of the '
+                                 'run to measure the end-to-end latency')
+        parser.add_argument('--stub-lrs-url', default=None,
+                            help='URL the workers reach the stub LRS at '
+                                 '(default: http://localhost:<port>/)')
+        parser.add_argument('--wait', type=float, default=30,
+                            help='Seconds to wait for statements to reach '
+                                 'the stub LRS after the last event')
+
+    def handle(self, *args, **options):
+        run_id = int(time.time())
+        payloads = list(loadgen.generate_payloads(
+            options['events'], options['kinds'], run_id))
+
+        lrs = lrs_config = None
+        if options['stub_lrs_port'] is not None:
+            lrs = StubLrs(host='0.0.0.0', port=options['stub_lrs_port'])
+            lrs.start()
+            lrs_config = self.register_stub_lrs(
+                options['stub_lrs_url']
+                or f'http://localhost:{lrs.server.server_address[1]}/')
+
+        try:
+            results = self.send(payloads, options)
+            self.report_acks(results)
+            if lrs:
+                self.report_end_to_end(results, lrs, run_id, options['wait'])
+        finally:
+            if lrs:
+                lrs_config.delete()
+                lrs.stop()
+
+    def send(self, payloads, options):
+        if options['target'] == 'tasks':
+            coroutine = loadgen.run_load(
+                loadgen.task_sender(schedule_xapi_task), payloads,
+                options['rate'], options['concurrency'])
+        else:
+            coroutine = loadgen.run_http_load(
+                options['url'], payloads, options['rate'],
+                options['concurrency'])
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def register_stub_lrs(self, url):
+        return LrsConfig.objects.create(
+            display_name=f'Load test stub LRS ({url})',
+            lrs_endpoint=url, lrs_auth_user='loadgen',
+            lrs_auth_pw='loadgen')
+
+    def report_acks(self, results):
+        summary = results.summary()
+        self.stdout.write(
+            f'Sent {summary["sent"]} events in {results.seconds:.2f}s '
+            f'({summary["per_second"]:.1f}/s), {summary["errors"]} errors')
+        for error, count in results.errors.most_common():
+            self.stdout.write(f'  {count:>7} {error}')
+        if results.latencies:
+            self.stdout.write('Ack latency: ' + '  '.join(
+                f'{name} {summary[name] * 1000:.1f}ms'
+                for name in ('p50', 'p90', 'p99', 'max')))
+
+    def report_end_to_end(self, results, lrs, run_id, wait):
+        expected = len(results.sent_at)
+        deadline = time.time() + wait
+        latencies = loadgen.end_to_end_latencies(results, lrs, run_id)
+        while len(latencies) < expected and time.time() < deadline:
+            time.sleep(0.5)
+            latencies = loadgen.end_to_end_latencies(results, lrs, run_id)
+
+        # Events no rule matches never reach the LRS
+        self.stdout.write(f'Delivered {len(latencies)} of {expected} events '
+                          f'to the stub LRS ({lrs.requests} requests)')
+        if latencies:
+            self.stdout.write('End-to-end latency: ' + '  '.join(
+                f'{name} {percentile(latencies, fraction) * 1000:.1f}ms'
+                for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                       ('p99', 0.99), ('max', 1))))
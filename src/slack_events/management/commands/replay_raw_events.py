@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from slack_events.raw_log import iter_raw_events
+from slack_events.tasks import schedule_xapi_batch_task
+
+
+class Command(BaseCommand):
+    help = ('Queues the payloads of the raw event log again, events that '
+            'are already stored are skipped by the pipeline')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after', type=int, default=0,
+                            help='Replay the events after this sequence')
+        parser.add_argument('--until', type=int, default=None,
+                            help='Replay the events up to this sequence')
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.SLACK_INGRESS_BATCH_SIZE,
+                            help='Number of events per queued task')
+
+    def handle(self, *args, **options):
+        replayed = 0
+        last_sequence = None
+        batch = []
+        for sequence, payload in iter_raw_events(options['after'],
+                                                 options['until']):
+            batch.append(payload)
+            last_sequence = sequence
+            if len(batch) >= options['batch_size']:
+                schedule_xapi_batch_task.delay(batch, log_raw=False)
+                replayed += len(batch)
+                batch = []
+        if batch:
+            schedule_xapi_batch_task.delay(batch, log_raw=False)
+            replayed += len(batch)
+        self.stdout.write(f'Queued {replayed} events (last sequence: '
+                          f'{last_sequence})')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from slack_events.slack_api import slack_client
+from xapi.actors import sync_slack_users, SYNC_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Creates or updates the xAPI actors of all members of the Slack '
+            'workspace')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SYNC_BATCH_SIZE,
+                            help='Number of actors saved per query')
+
+    def handle(self, *args, **options):
+        created, updated = sync_slack_users(
+            slack_client, batch_size=options['batch_size'])
+        self.stdout.write(f'Created {created} and updated {updated} actors')
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0019_slackevent_has_attachments'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xapistatement',
+            name='delivered',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
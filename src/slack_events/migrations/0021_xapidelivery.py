@@ -0,0 +1,31 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xapi', '0014_auto_20201010_1351'),
+        ('slack_events', '0020_auto_20261018_1308'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XApiDelivery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('delivered', 'Delivered'), ('failed', 'Failed')], db_index=True, default='pending', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('lrs_config', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='xapi.lrsconfig')),
+                ('statement', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='slack_events.xapistatement')),
+            ],
+            options={
+                'verbose_name': 'xAPI Delivery',
+                'verbose_name_plural': 'xAPI Deliveries',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0021_xapidelivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xapidelivery',
+            name='delivered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
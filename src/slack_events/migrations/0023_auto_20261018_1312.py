@@ -0,0 +1,32 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0022_xapidelivery_delivered_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xapidelivery',
+            name='last_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='xapidelivery',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='xapidelivery',
+            index=models.Index(fields=['lrs_config', 'status', 'next_attempt_at'], name='slack_event_lrs_con_1091db_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='xapidelivery',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='slack_event_status_39730f_idx'),
+        ),
+    ]
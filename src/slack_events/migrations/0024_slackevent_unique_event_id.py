@@ -0,0 +1,35 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:16
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def clear_duplicate_event_ids(apps, schema_editor):
+    """ Slack retries were stored as separate events before, keep the
+    event_id on the first one only """
+    SlackEvent = apps.get_model('slack_events', 'SlackEvent')
+    duplicate_event_ids = (
+        SlackEvent.objects.exclude(event_id=None)
+        .values('event_id').annotate(count=Count('pk'))
+        .filter(count__gt=1).values_list('event_id', flat=True))
+    for event_id in duplicate_event_ids:
+        first = SlackEvent.objects.filter(event_id=event_id).order_by('pk')[0]
+        SlackEvent.objects.filter(event_id=event_id).exclude(
+            pk=first.pk).update(event_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0023_auto_20261018_1312'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_event_ids,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='slackevent',
+            name='event_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
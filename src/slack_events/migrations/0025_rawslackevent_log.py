@@ -0,0 +1,28 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0024_slackevent_unique_event_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rawslackevent',
+            name='data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rawslackevent',
+            name='event_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='rawslackevent',
+            name='first_sequence',
+            field=models.PositiveBigIntegerField(blank=True, null=True, unique=True),
+        ),
+    ]
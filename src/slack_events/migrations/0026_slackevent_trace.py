@@ -0,0 +1,29 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:38
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0025_rawslackevent_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slackevent',
+            name='latency',
+            field=models.DurationField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='slackevent',
+            name='received_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='slackevent',
+            name='trace',
+            field=jsonfield.fields.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-18 13:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slack_events', '0026_slackevent_trace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xapidelivery',
+            name='claim',
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+    ]
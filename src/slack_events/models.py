@@ -1,46 +1,77 @@
 import collections
+from contextlib import contextmanager
 from datetime import datetime
 import json
 import logging
-import re
+import time
+import zlib
 
 from django.conf import settings
 from django.db import models
-from django.contrib.auth.models import User
+from django.utils import timezone
 
 from jsonfield import JSONField
-import pytz
-from slack import WebClient
-
-from xapi.models import XApiActor, XApiVerb, XApiObject
-from xapi.models import ACTOR_IRI_TYPES
-from main.helper import get_or_none, create_sha1
+from slack.errors import SlackApiError
+
+from xapi.models import XApiActor, XApiVerb, XApiObject, LrsConfig
+from xapi.actors import (get_admin_user, actor_from_slack_user,
+                         UnresolvableSlackUser)
+from main import metrics
+from main.helper import get_or_none
+from .envelope import SlackEventEnvelope
+from .normalize import (normalize_payload, from_unix_to_localtime,
+                        get_mentions_from_message)
 from .helper import (get_file_permalink, get_channel_permalink,
                      get_reaction_permalink, get_message_permalink,
                      get_star_or_pin_permalink)
+from .slack_api import SlackRateLimited, slack_client
 
 log = logging.getLogger(__name__)
-TZ = pytz.timezone('Europe/Dublin')
 SLACK_USER_API = ''
-slack_client = WebClient(token=settings.SLACK_OAUTH_TOKEN)
+DELIVERY_STATUS_CHOICES = [
+    ('pending', 'Pending'),
+    ('sending', 'Sending'),
+    ('delivered', 'Delivered'),
+    ('failed', 'Failed'),
+]
 
 
 class RawSlackEvent(models.Model):
+    """ Append-only log of the received payloads, each row holds a batch of
+    payloads compressed together and numbered from first_sequence on.
+    Rows written before the log was batched hold a single `payload` """
     created_at = models.DateTimeField(auto_now_add=True)
     payload = JSONField(
         null=True, load_kwargs={'object_pairs_hook': collections.OrderedDict})
+    first_sequence = models.PositiveBigIntegerField(null=True, blank=True,
+                                                    unique=True)
+    event_count = models.PositiveIntegerField(default=1)
+    data = models.BinaryField(null=True, blank=True)
 
     class Meta:
         verbose_name = "Raw Slack Event"
         verbose_name_plural = 'Raw Slack Events'
 
+    def __str__(self):
+        if self.first_sequence is None:
+            return f'Raw Slack Event at {self.created_at}'
+        return (f'Raw Slack Events {self.first_sequence} to '
+                f'{self.first_sequence + self.event_count - 1}')
+
+    def get_payloads(self):
+        """ Returns the serialized payloads of the row """
+        if self.data is None:
+            return [json.dumps(self.payload)] if self.payload else []
+        return zlib.decompress(self.data).decode('utf-8').split('\n')
+
 
 class SlackEvent(models.Model):
     team_id = models.CharField(max_length=25, null=True, blank=True)
     api_type = models.CharField(max_length=25, null=True, blank=True)
     event_type = models.CharField(max_length=255, null=True, blank=True)
     event_subtype = models.CharField(max_length=255, null=True, blank=True)
-    event_id = models.CharField(max_length=255, null=True, blank=True)
+    event_id = models.CharField(max_length=255, null=True, blank=True,
+                                unique=True)
     event_time = models.DateField(null=True, blank=True)
     message_text = models.TextField(null=True, blank=True)
     user_id = models.CharField(max_length=255, null=True, blank=True)
@@ -54,6 +85,11 @@ class SlackEvent(models.Model):
     has_attachments = models.BooleanField(default=False)
     permalink = models.CharField(max_length=1048, null=True, blank=True)
     file_ids = JSONField(null=True, blank=True)
+    # When the webhook received the event and how long it took until it was
+    # delivered to every LRS, the trace holds the steps in between
+    received_at = models.DateTimeField(null=True, blank=True)
+    latency = models.DurationField(null=True, blank=True, db_index=True)
+    trace = JSONField(null=True, blank=True)
 
     _payload = JSONField(null=True, blank=True)
 
@@ -64,69 +100,78 @@ class SlackEvent(models.Model):
     def __str__(self):
         return f'@{self.user_id} {self.event_type} {(self.event_subtype or "")} at {self.event_time}'  # noqa: E501
 
+    @classmethod
+    def from_envelope(cls, envelope):
+        """ Creates an unsaved event sharing the already decoded payload of
+        an envelope """
+        slack_event = cls(_payload=envelope.serialized)
+        slack_event._envelope = envelope
+        return slack_event
+
+    @property
+    def envelope(self):
+        """ The decoded payload, only decoded again if _payload changed """
+        envelope = getattr(self, '_envelope', None)
+        if envelope is None or envelope.serialized is not self._payload:
+            envelope = SlackEventEnvelope.from_json(self._payload)
+            self._envelope = envelope
+        return envelope
+
+    def start_trace(self, received_at=None, enqueued_at=None,
+                    started_at=None):
+        """ Starts the trace of the event with the (unix) times it was
+        received by the webhook, queued and picked up by a worker. The
+        durations of the stages are added with traced_stage() """
+        if not settings.SLACK_EVENT_TRACE_ENABLED:
+            return
+        if received_at:
+            self.received_at = datetime.fromtimestamp(received_at,
+                                                      tz=timezone.utc)
+        self.trace = {
+            'received_at': received_at,
+            'enqueued_at': enqueued_at,
+            'started_at': started_at or time.time(),
+            'stages': {},
+        }
+
+    def record_stage(self, stage, seconds):
+        if self.trace is not None:
+            self.trace['stages'][stage] = round(seconds, 6)
+
+    @contextmanager
+    def traced_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    def trace_durations(self):
+        """ Returns the seconds spent in the webhook process, in the broker
+        queue and in every stage of the tasks """
+        trace = self.trace or {}
+        durations = {}
+        if trace.get('received_at') and trace.get('enqueued_at'):
+            durations['ingress'] = (trace['enqueued_at']
+                                    - trace['received_at'])
+        if trace.get('enqueued_at') and trace.get('started_at'):
+            durations['queue'] = trace['started_at'] - trace['enqueued_at']
+        durations.update(trace.get('stages', {}))
+        return durations
+
     def save(self, *args, **kwargs):
         """ Custom save function to convert the payload to individual
-        fields """
-        data = json.loads(self._payload)
-        event_content = data.get('event', {})
-
-        self.team_id = data.get('team_id')
-        self.api_type = data.get('type')
-        self.event_id = data.get('event_id')
-        self.event_time = self.from_unix_to_localtime(data.get('event_time'))
-        self.event_type = event_content.get('type')
-        self.event_subtype = event_content.get('subtype')
-        if event_content.get('type') == 'user_change':
-            self.user_id = event_content.get('user', {}).get('id')
-        else:
-            self.user_id = (event_content.get('user')
-                            or event_content.get('user_id')
-                            or data.get('authorizations')[0].get('user_id'))
-        self.message_text = event_content.get('text')
-        self.channel = event_content.get('channel')
-        self.channel_type = event_content.get('channel_type')
-        self.attachments = event_content.get('attachments')
-        if event_content.get('attachments'):
-            self.has_attachments = True
-        message_ts = (event_content.get('ts')
-                      or event_content.get('event_ts')
-                      or event_content.get('item', {}).get('event_ts')
-                      or event_content.get('message', {}).get('event_ts'))
-        self.ts = self.from_unix_to_localtime(
-            timestamp=message_ts, tz=TZ)
-
-        # If event has a message, then take these values
-        if event_content.get('message'):
-            msg_content = event_content.get('message')
-            self.user_id = msg_content.get('user')
-            self.message_text = msg_content.get('text')
-            self.attachments = msg_content.get('attachments')
-        if event_content.get('item'):
-            item_content = event_content.get('item')
-            self.message_text = event_content.get('reaction')
-            self.event_subtype = item_content.get('type')
-            self.channel = item_content.get('channel')
-
-        self.has_files = bool(
-            event_content.get('files') or event_content.get('file') or
-            event_content.get('attachment', {}).get('files') or
-            event_content.get('item', {}).get('message', {}).get('items')
-            or event_content.get('file_id'))
-
-        if event_content.get('files'):
-            self.file_ids = [shared_file.get('id')
-                             for shared_file in event_content.get('files')]
-        else:
-            file_id = (event_content.get('file_id') or
-                       event_content.get('file', {}).get('id'))
-            self.file_ids = [file_id]
-
-        self.permalink = self.get_permalink_from_slack()
-        self.mentioned_users = self.get_mentions_from_message(self.message_text)  # noqa: E501
-        if self.mentioned_users:
-            self.has_mentions = True
+        fields, the conversion itself is done by normalize_payload """
+        self.populate_from_payload()
         super(SlackEvent, self).save(*args, **kwargs)
 
+    def populate_from_payload(self):
+        """ Converts the payload to the individual fields """
+        with metrics.timer('slack_normalize_seconds'):
+            fields = normalize_payload(self.envelope)
+        for field, value in fields.items():
+            setattr(self, field, value)
+
     def get_attachments(self):
         return json.loads(self.attachments)
 
@@ -134,95 +179,114 @@ class SlackEvent(models.Model):
         return json.loads(self.mentioned_users)
 
     def get_payload(self):
-        return json.loads(self._payload)
-
-    @staticmethod
-    def from_unix_to_localtime(timestamp, tz=None):
-        if (isinstance(timestamp, str)):
-            timestamp = float(timestamp)
-        utc_dt = datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
-        if not tz:
-            return utc_dt
-        return tz.normalize(utc_dt.astimezone(tz))
-
-    @staticmethod
-    def get_mentions_from_message(message_text):
-        if not message_text or message_text == '':
-            return None
-        regex_pattern = r'[<][@]((?:[A-Z]|[0-9])*)[>]'
-        return re.findall(regex_pattern, message_text)
+        return self.envelope.payload
+
+    from_unix_to_localtime = staticmethod(from_unix_to_localtime)
+    get_mentions_from_message = staticmethod(get_mentions_from_message)
 
     def slack_event_to_xapi_statement(self):
+        xapi_statement = self.build_xapi_statement()
+        if not xapi_statement:
+            return None
+        statement = XApiStatement(
+            statement=json.dumps(xapi_statement, default=str),
+            slack_event=self)
+        statement.save()
+        metrics.increment('xapi_statements_saved_total')
+        return xapi_statement
+
+    def build_xapi_statement(self):
+        """ Maps the event to the xAPI statement without saving it, the
+        event itself does not need to be saved yet """
         xapi_statement = {}
-        xapi_actor = XApiActor.slack_id_to_xapi_actor(self)
-        # If actor is not found try yo create the actor automatically
-        # if the setting is enabled
-        if not xapi_actor:
-            xapi_actor = self.create_actor_from_slack()
+        # Match the verb and object first, they do not need the database or
+        # the Slack API, so events without a statement stop here
+        with metrics.timer('xapi_rule_match_seconds'):
+            xapi_verb = XApiVerb.slack_event_to_xapi_verb(self)
+            xobject = (XApiObject.match_slack_event(self) if xapi_verb
+                       else None)
+        # If no matching verb or object was found return None
+        if not xapi_verb:
+            metrics.increment('xapi_statements_built_total', result='no_verb')
+            return None
+        if not xobject:
+            metrics.increment('xapi_statements_built_total',
+                              result='no_object')
+            return None
+        # Unknown actors are created automatically if the setting is enabled
+        with self.traced_stage('actor'):
+            xapi_actor = XApiActor.slack_id_to_xapi_actor(self)
         # If no actor is found and a new one cannot be created return None
         if not xapi_actor:
+            metrics.increment('xapi_statements_built_total',
+                              result='no_actor')
             return None
+        metrics.increment('xapi_statements_built_total', result='built')
+        if xobject.uses_permalink():
+            with self.traced_stage('permalink'):
+                self.enrich_permalink()
         xapi_statement.update(xapi_actor)
-        xapi_verb = XApiVerb.slack_event_to_xapi_verb(self)
-        # If no matching verb was found return None
-        if not xapi_verb:
-            return None
         xapi_statement.update(xapi_verb)
-        xapi_object = XApiObject.slack_event_to_xapi_object(self)
-        # If no matching object was found return None
-        if not xapi_object:
-            return None
-        xapi_statement.update(xapi_object)
-        statement = XApiStatement(
-            statement=json.dumps(xapi_statement, default=str),
-            slack_event=self)
-        statement.save()
+        xapi_statement.update(xobject.model_to_xapi_object(self))
         return xapi_statement
 
     def create_actor_from_slack(self):
         """ Check if Actor exists and try to create it by looking up the info
         from their Slack profile if feature is enabled """
-        if not settings.ACTOR_CREATION_ENABLED:
-            log.warning("Automatic actor creation not enabled")
-            return
-
         existing_actor = get_or_none(XApiActor, slack_user_id=self.user_id)
         if existing_actor:
             return existing_actor
+        return self.create_new_actor_from_slack()
 
-        admin_user = get_or_none(User, username='admin')
+    def create_new_actor_from_slack(self):
+        """ Creates the Actor of a user that has none yet by looking up the
+        info from their Slack profile if feature is enabled, for callers
+        that have already looked for the Actor (see resolve_actor) """
+        if not settings.ACTOR_CREATION_ENABLED:
+            log.warning("Automatic actor creation not enabled")
+            return
+
+        admin_user = get_admin_user()
         if not admin_user:
             log.warning("Admin user for automatic actor creation not found")
             return
 
-        slack_call = slack_client.users_info(user=self.user_id)
-        if not slack_call.get('ok'):
+        try:
+            slack_call = slack_client.users_info(user=self.user_id)
+        except SlackRateLimited:
+            # Not a reason to give up on the user, the task is retried
+            raise
+        except SlackApiError as error:
+            if (error.response is not None
+                    and error.response.get('error') == 'user_not_found'):
+                raise UnresolvableSlackUser('not found in Slack')
+            log.warning(f'Could not look up Slack user {self.user_id}: '
+                        f'{error}')
             return
-
-        user_data = slack_call.get('user')
-        email = user_data.get('profile', {}).get('email')
-        if not email:
-            log.warning("No email in Slack user found")
+        if not slack_call.get('ok'):
             return
 
-        if settings.ACTOR_IRI_TYPE not in [t[0] for t in ACTOR_IRI_TYPES]:
-            log.warning("Iri type declared is invalid")
+        user_data = slack_call.get('user') or {}
+        if not user_data.get('profile', {}).get('email'):
+            raise UnresolvableSlackUser('no email address in Slack')
+        actor = actor_from_slack_user(user_data, admin_user)
+        if not actor:
             return
-
-        if settings.ACTOR_IRI_TYPE == 'mbox_sha1sum':
-            email = create_sha1(email)
-
-        actor = XApiActor(
-            created_by=admin_user,
-            slack_user_id=self.user_id,
-            iri=email,
-            iri_type=settings.ACTOR_IRI_TYPE,
-            display_name=(
-                user_data.get('profile', {}).get('display_name')
-                or user_data.get('real_name'))
-        )
         actor.save()
-        return get_or_none(XApiActor, slack_user_id=self.user_id)
+        return actor
+
+    def enrich_permalink(self):
+        """ Looks up the permalink of an event through the Slack API, it is
+        stored straight away if the event has already been saved. This is
+        kept out of save() so that persisting an event never waits on
+        Slack, it only runs for events whose statement uses it """
+        if self.permalink:
+            return self.permalink
+        self.permalink = self.get_permalink_from_slack()
+        if self.permalink and self.pk:
+            SlackEvent.objects.filter(pk=self.pk).update(
+                permalink=self.permalink)
+        return self.permalink
 
     def get_permalink_from_slack(self):
         """ Gets the permalink for the message, file or conversation through
@@ -255,7 +319,7 @@ class SlackEvent(models.Model):
 
 class XApiStatement(models.Model):
     statement = JSONField()
-    delivered = models.BooleanField(default=False)
+    delivered = models.BooleanField(default=False, db_index=True)
     slack_event = models.ForeignKey(SlackEvent, on_delete=models.CASCADE,
                                     related_name="slack_event")
 
@@ -265,3 +329,38 @@ class XApiStatement(models.Model):
 
     def __str__(self):
         return f'{self.slack_event} (delivered: {self.delivered})'
+
+    def get_statement(self):
+        if isinstance(self.statement, str):
+            return json.loads(self.statement)
+        return self.statement
+
+
+class XApiDelivery(models.Model):
+    """ Outbox entry for the delivery of a statement to one LRS """
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    statement = models.ForeignKey(XApiStatement, on_delete=models.CASCADE,
+                                  related_name='deliveries')
+    lrs_config = models.ForeignKey(LrsConfig, on_delete=models.CASCADE,
+                                   related_name='deliveries')
+    status = models.CharField(max_length=20, choices=DELIVERY_STATUS_CHOICES,
+                              default='pending', db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    # Token of the flush that claimed the delivery for sending
+    claim = models.CharField(max_length=32, null=True, blank=True,
+                             db_index=True)
+
+    class Meta:
+        verbose_name = "xAPI Delivery"
+        verbose_name_plural = 'xAPI Deliveries'
+        indexes = [
+            models.Index(fields=['lrs_config', 'status', 'next_attempt_at']),
+            models.Index(fields=['status', 'next_attempt_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.statement} to {self.lrs_config} ({self.status})'
@@ -0,0 +1,96 @@
+from datetime import datetime
+import re
+
+import pytz
+
+from .envelope import to_envelope
+
+TZ = pytz.timezone('Europe/Dublin')
+MENTION_PATTERN = re.compile(r'[<][@]((?:[A-Z]|[0-9])*)[>]')
+
+
+def from_unix_to_localtime(timestamp, tz=None):
+    if (isinstance(timestamp, str)):
+        timestamp = float(timestamp)
+    utc_dt = datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
+    if not tz:
+        return utc_dt
+    return tz.normalize(utc_dt.astimezone(tz))
+
+
+def get_mentions_from_message(message_text):
+    if not message_text or message_text == '':
+        return None
+    return MENTION_PATTERN.findall(message_text)
+
+
+def normalize_payload(payload):
+    """ Converts a Slack Events API payload (or its envelope) to the values
+    of the individual SlackEvent fields, without touching the database or
+    the Slack API
+
+    Returns a dict of field names and values """
+    envelope = to_envelope(payload)
+    data = envelope.payload
+    event_content = envelope.event
+
+    if event_content.get('type') == 'user_change':
+        user_id = event_content.get('user', {}).get('id')
+    else:
+        user_id = (event_content.get('user')
+                   or event_content.get('user_id')
+                   or data.get('authorizations')[0].get('user_id'))
+    message_text = event_content.get('text')
+    channel = event_content.get('channel')
+    attachments = event_content.get('attachments')
+    message_ts = (event_content.get('ts')
+                  or event_content.get('event_ts')
+                  or event_content.get('item', {}).get('event_ts')
+                  or event_content.get('message', {}).get('event_ts'))
+
+    # If event has a message, then take these values
+    if event_content.get('message'):
+        msg_content = event_content.get('message')
+        user_id = msg_content.get('user')
+        message_text = msg_content.get('text')
+        attachments = msg_content.get('attachments')
+    if event_content.get('item'):
+        message_text = event_content.get('reaction')
+        channel = event_content.get('item').get('channel')
+
+    if event_content.get('files'):
+        file_ids = [shared_file.get('id')
+                    for shared_file in event_content.get('files')]
+    else:
+        file_ids = [event_content.get('file_id') or
+                    event_content.get('file', {}).get('id')]
+
+    mentioned_users = get_mentions_from_message(message_text)
+    return {
+        'team_id': envelope.team_id,
+        'api_type': data.get('type'),
+        'event_id': envelope.event_id,
+        'event_time': from_unix_to_localtime(data.get('event_time')),
+        'event_type': envelope.event_type,
+        'event_subtype': envelope.event_subtype,
+        'user_id': user_id,
+        'message_text': message_text,
+        'channel': channel,
+        'channel_type': event_content.get('channel_type'),
+        'attachments': attachments,
+        'has_attachments': bool(event_content.get('attachments')),
+        'ts': from_unix_to_localtime(timestamp=message_ts, tz=TZ),
+        'has_files': bool(
+            event_content.get('files') or event_content.get('file') or
+            event_content.get('attachment', {}).get('files') or
+            event_content.get('item', {}).get('message', {}).get('items')
+            or event_content.get('file_id')),
+        'file_ids': file_ids,
+        'mentioned_users': mentioned_users,
+        'has_mentions': bool(mentioned_users),
+    }
+
+
+def normalize_payloads(payloads):
+    """ Normalizes a list of payloads, e.g. for backfills and batches """
+    return [normalize_payload(payload) for payload in payloads]
@@ -0,0 +1,86 @@
+import logging
+import zlib
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import ExpressionWrapper, F
+
+from .envelope import SlackEventEnvelope
+from .models import RawSlackEvent
+
+log = logging.getLogger(__name__)
+SEQUENCE_RETRIES = 5
+
+
+# The sequence number following the last payload of a row
+END_SEQUENCE = ExpressionWrapper(
+    F('first_sequence') + F('event_count'),
+    output_field=models.PositiveBigIntegerField())
+
+
+def next_sequence():
+    # Read from the end of the unique index instead of scanning the log
+    last = RawSlackEvent.objects.filter(
+        first_sequence__isnull=False,
+    ).order_by('-first_sequence').values_list(
+        'first_sequence', 'event_count').first()
+    if not last:
+        return 1
+    first_sequence, event_count = last
+    return first_sequence + event_count
+
+
+def append_raw_events(payloads):
+    """ Appends serialized payloads to the raw event log as one compressed
+    row. The payloads are numbered consecutively, a row that lost the race
+    for its sequence numbers to a concurrent writer is tried again with the
+    next free ones
+
+    Returns the RawSlackEvent or None if the log is disabled """
+    if not payloads or not settings.RAW_EVENT_LOG_ENABLED:
+        return None
+    # Line breaks in JSON can only be whitespace between tokens
+    data = zlib.compress('\n'.join(
+        payload.replace('\n', ' ') for payload in payloads).encode('utf-8'))
+    for _ in range(SEQUENCE_RETRIES):
+        try:
+            with transaction.atomic():
+                return RawSlackEvent.objects.create(
+                    first_sequence=next_sequence(),
+                    event_count=len(payloads), data=data)
+        except IntegrityError:
+            continue
+    raise IntegrityError('Could not allocate raw event sequence numbers')
+
+
+def iter_raw_events(after=0, until=None, chunk_size=100):
+    """ Yields the (sequence, serialized payload) of the logged events with a
+    sequence number above `after`, up to and including `until` """
+    rows = RawSlackEvent.objects.annotate(
+        end_sequence=END_SEQUENCE,
+    ).filter(
+        first_sequence__isnull=False, end_sequence__gt=after + 1,
+    ).order_by('first_sequence')
+    if until is not None:
+        rows = rows.filter(first_sequence__lte=until)
+
+    for row in rows.iterator(chunk_size=chunk_size):
+        for sequence, payload in enumerate(row.get_payloads(),
+                                           start=row.first_sequence):
+            if sequence <= after:
+                continue
+            if until is not None and sequence > until:
+                return
+            yield sequence, payload
+
+
+def last_raw_event():
+    """ Returns the envelope of the last logged payload, or None """
+    row = RawSlackEvent.objects.order_by(
+        F('first_sequence').desc(nulls_last=True), '-pk').first()
+    if not row:
+        return None
+    payloads = row.get_payloads()
+    if not payloads:
+        return None
+    return SlackEventEnvelope.from_json(payloads[-1])
@@ -0,0 +1,183 @@
+from email.utils import parsedate_to_datetime
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from slack import WebClient
+from slack.errors import SlackApiError
+
+from main import metrics
+
+log = logging.getLogger(__name__)
+BUCKET_KEY = 'slack:rate:{}:{}'
+BLOCKED_KEY = 'slack:rate:{}:blocked_until'
+# Slack counts the calls of a method per minute, the budget of a method
+# depends on its tier (https://api.slack.com/docs/rate-limits)
+RATE_WINDOW = 60
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100}
+METHOD_TIERS = {
+    'users.list': 2,
+    'users.info': 4,
+    'team.info': 3,
+    'files.info': 4,
+    'chat.getPermalink': 4,
+}
+DEFAULT_TIER = 3
+DEFAULT_RETRY_AFTER = 1
+
+
+class SlackRateLimited(SlackApiError):
+    """ A Slack API method cannot be called again within
+    SLACK_API_MAX_WAIT seconds, it can be tried after `retry_after`
+    seconds """
+    def __init__(self, method, retry_after, response=None):
+        super().__init__(f'{method} is rate limited for {retry_after:.1f}s',
+                         response)
+        self.method = method
+        self.retry_after = retry_after
+
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SlackClient(WebClient):
+    """ WebClient for all Slack API calls of a process.
+
+    Every method has a budget of calls per minute (its rate tier), kept in
+    the Django cache so that it is shared by the processes using the same
+    cache. A call over the budget or after Slack answered with a 429 waits
+    until the method is available again, but at most SLACK_API_MAX_WAIT
+    seconds, otherwise SlackRateLimited is raised. Identical calls made
+    at the same time by several threads are sent once and share the
+    response. The calls are counted and timed per method """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+
+    def api_call(self, api_method, **kwargs):
+        key = (api_method, json.dumps(kwargs, sort_keys=True, default=str))
+        with self.in_flight_lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = InFlightCall()
+
+        if not leader:
+            metrics.increment('slack_api_coalesced_total', method=api_method)
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = self.rate_limited_call(api_method, **kwargs)
+            return call.response
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+            call.done.set()
+
+    def rate_limited_call(self, api_method, **kwargs):
+        deadline = time.time() + settings.SLACK_API_MAX_WAIT
+        while True:
+            self.acquire(api_method, deadline)
+            try:
+                return self.timed_call(api_method, **kwargs)
+            except SlackApiError as error:
+                if getattr(error.response, 'status_code', None) != 429:
+                    raise
+                retry_after = parse_retry_after(error.response.headers)
+                metrics.increment('slack_api_rate_limited_total',
+                                  method=api_method, source='slack')
+                log.warning(f'Slack rate limited {api_method} for '
+                            f'{retry_after}s')
+                cache.set(BLOCKED_KEY.format(api_method),
+                          time.time() + retry_after,
+                          timeout=int(retry_after) + 1)
+
+    def timed_call(self, api_method, **kwargs):
+        result = 'error'
+        try:
+            with metrics.timer('slack_api_request_seconds',
+                               method=api_method):
+                response = super().api_call(api_method, **kwargs)
+            result = 'ok' if response.get('ok') else response.get('error')
+            return response
+        except SlackApiError as error:
+            if error.response is not None:
+                result = error.response.get('error') or result
+            raise
+        finally:
+            metrics.increment('slack_api_requests_total', method=api_method,
+                              result=result)
+
+    def acquire(self, api_method, deadline):
+        """ Takes one call from the budget of the method, waiting for the
+        next window or for Slack's Retry-After to pass if need be
+
+        Raises SlackRateLimited if that is past the deadline """
+        limit = TIER_LIMITS[METHOD_TIERS.get(api_method, DEFAULT_TIER)]
+        waited = 0
+        while True:
+            now = time.time()
+            available_at = cache.get(BLOCKED_KEY.format(api_method)) or 0
+            if available_at <= now:
+                window = int(now // RATE_WINDOW)
+                if take_call(BUCKET_KEY.format(api_method, window)) <= limit:
+                    if waited:
+                        metrics.observe('slack_api_wait_seconds', waited,
+                                        method=api_method)
+                    return
+                available_at = (window + 1) * RATE_WINDOW
+            if available_at > deadline:
+                metrics.increment('slack_api_rate_limited_total',
+                                  method=api_method, source='budget')
+                raise SlackRateLimited(api_method, available_at - now)
+            time.sleep(available_at - now)
+            waited += available_at - now
+
+
+def take_call(bucket_key):
+    """ Counts a call in a window of a method, returns the calls made in the
+    window so far """
+    cache.add(bucket_key, 0, timeout=RATE_WINDOW * 2)
+    try:
+        return cache.incr(bucket_key)
+    except ValueError:
+        # The window expired in between
+        cache.set(bucket_key, 1, timeout=RATE_WINDOW * 2)
+        return 1
+
+
+def parse_retry_after(headers, default=DEFAULT_RETRY_AFTER):
+    """ Returns the seconds of a Retry-After header, whatever its case, given
+    in seconds or as an HTTP date. `default` if there is none or it cannot
+    be parsed """
+    for name, value in (headers or {}).items():
+        if name.lower() != 'retry-after':
+            continue
+        try:
+            return max(float(value), 0)
+        except (TypeError, ValueError):
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp()
+                       - time.time(), 0)
+        except (TypeError, ValueError):
+            break
+    return default
+
+
+slack_client = SlackClient(token=settings.SLACK_OAUTH_TOKEN)
@@ -0,0 +1,195 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+OPEN_SUFFIX = '.open'
+SEALED_SUFFIX = '.spool'
+DRAINING_SUFFIX = '.draining'
+
+
+class EventSpool:
+    """ Append-only spool of serialized Slack payloads, used by a web
+    process to hold on to events while the broker cannot take them.
+
+    Each process writes to its own segment file, one JSON encoded payload
+    per line. Writes are handed to the OS straight away but only synced to
+    disk every `fsync_interval` seconds, so a burst of events shares one
+    fsync. The last writes of a burst are synced by a timer at the end of
+    the interval. A segment is sealed once it reaches `segment_size` bytes
+    or the broker is reachable again, only sealed segments are drained.
+    The open segment is locked while it is written to, so it is only taken
+    over by the drainer once its process is gone """
+
+    def __init__(self, directory, segment_size, fsync_interval):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file = None
+        self.last_fsync = 0
+        self.unsynced = False
+        self.fsync_timer = None
+
+    def append(self, payloads):
+        lines = ''.join(json.dumps(payload) + '\n' for payload in payloads)
+        with self.lock:
+            if self.file is None:
+                self.open_segment()
+            self.file.write(lines.encode('utf-8'))
+            self.file.flush()
+            self.unsynced = True
+            since_fsync = time.monotonic() - self.last_fsync
+            if since_fsync >= self.fsync_interval:
+                self.fsync()
+            else:
+                self.schedule_fsync(self.fsync_interval - since_fsync)
+            if self.file.tell() >= self.segment_size:
+                self.close_segment()
+        log.warning(f'Spooled {len(payloads)} events to {self.directory}')
+
+    def seal(self):
+        """ Makes the current segment available to the drainer """
+        if self.file is None:
+            return
+        with self.lock:
+            if self.file is not None:
+                self.close_segment()
+
+    def open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f'{time.time_ns():020d}-{os.getpid()}'
+        self.file = open(os.path.join(self.directory, name + OPEN_SUFFIX),
+                         'ab')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def close_segment(self):
+        self.fsync()
+        path = self.file.name
+        os.rename(path, path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        self.file.close()
+        self.file = None
+
+    def fsync(self):
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+    def schedule_fsync(self, delay):
+        if self.fsync_timer is not None:
+            return
+        self.fsync_timer = threading.Timer(delay, self.fsync_unsynced)
+        self.fsync_timer.daemon = True
+        self.fsync_timer.start()
+
+    def fsync_unsynced(self):
+        with self.lock:
+            self.fsync_timer = None
+            if self.file is not None and self.unsynced:
+                self.fsync()
+
+
+def is_locked(path):
+    """ Checks if the process writing to an open segment is still alive """
+    try:
+        with open(path, 'rb') as segment:
+            try:
+                fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(segment.fileno(), fcntl.LOCK_UN)
+            return False
+    except FileNotFoundError:
+        return True
+
+
+def claim_segments(directory, stale_after):
+    """ Claims the sealed segments, and the open segments not written to
+    for `stale_after` seconds whose process is gone (it no longer holds
+    their lock), by renaming them so that concurrent drainers do not replay
+    them twice
+
+    Returns the paths of the claimed segments, oldest first """
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+
+    claimed = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith(OPEN_SUFFIX):
+            try:
+                if time.time() - os.path.getmtime(path) < stale_after:
+                    continue
+            except FileNotFoundError:
+                continue
+            if is_locked(path):
+                continue
+        elif not name.endswith(SEALED_SUFFIX):
+            continue
+        draining_path = os.path.splitext(path)[0] + DRAINING_SUFFIX
+        try:
+            os.rename(path, draining_path)
+        except FileNotFoundError:
+            continue
+        claimed.append(draining_path)
+    return claimed
+
+
+def read_segment(path):
+    with open(path, 'rb') as segment:
+        for line in segment:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # The last line of a segment may have been cut off
+                log.error(f'Skipping a corrupt line in {path}')
+
+
+def drain_spool(publish, directory, batch_size, stale_after):
+    """ Replays the spooled payloads with `publish` in batches and removes
+    every segment once all of it has been published. A segment that could
+    not be published is put back to be drained again later, events that
+    were published twice are skipped by the pipeline tasks
+
+    Returns the number of replayed payloads """
+    drained = 0
+    segments = claim_segments(directory, stale_after)
+    for index, path in enumerate(segments):
+        payloads = list(read_segment(path))
+        try:
+            for start in range(0, len(payloads), batch_size):
+                publish(payloads[start:start + batch_size])
+        except Exception:
+            log.exception(f'Could not replay the spooled events of {path}')
+            for unpublished in segments[index:]:
+                os.rename(unpublished,
+                          os.path.splitext(unpublished)[0] + SEALED_SUFFIX)
+            break
+        os.remove(path)
+        drained += len(payloads)
+    return drained
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool():
+    """ Returns the spool of this process for SLACK_SPOOL_DIR """
+    directory = str(settings.SLACK_SPOOL_DIR)
+    with _spools_lock:
+        if directory not in _spools:
+            _spools[directory] = EventSpool(
+                directory,
+                segment_size=settings.SLACK_SPOOL_SEGMENT_SIZE,
+                fsync_interval=settings.SLACK_SPOOL_FSYNC_INTERVAL / 1000)
+            atexit.register(_spools[directory].seal)
+        return _spools[directory]
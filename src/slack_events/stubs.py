@@ -0,0 +1,213 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubServer:
+    """ Runs a local HTTP server in a background thread, used to stand in for
+    external services in tests and benchmarks """
+    handler_class = None
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so that clients can keep connections alive
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubLrsHandler(StubHandler):
+    def do_POST(self):
+        stub = self.stub
+        statements = json.loads(self.read_body() or b'[]')
+        if not isinstance(statements, list):
+            statements = [statements]
+        received_at = time.time()
+        with stub.lock:
+            stub.requests += 1
+            stub.connections.add(self.client_address)
+            for statement in statements:
+                stub.statements.append((received_at, statement))
+        self.send_json(stub.status, [str(index) for index in
+                                     range(len(statements))])
+
+
+class StubLrs(StubServer):
+    """ Accepts xAPI statements (single or batched) and records them together
+    with the time they were received """
+    handler_class = StubLrsHandler
+
+    def __init__(self, status=200, **kwargs):
+        super().__init__(**kwargs)
+        self.status = status
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = set()
+        self.statements = []
+
+
+class StubSlackApiHandler(StubHandler):
+    def do_GET(self):
+        self.handle_api_call()
+
+    def do_POST(self):
+        self.handle_api_call()
+
+    def handle_api_call(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in
+                  parse_qs(url.query).items()}
+        body = self.read_body()
+        if body:
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params.update(json.loads(body))
+            else:
+                params.update({key: values[0] for key, values in
+                               parse_qs(body.decode('utf-8')).items()})
+
+        method = url.path.rsplit('/', 1)[-1]
+        stub = self.stub
+        with stub.lock:
+            stub.calls.append((method, params))
+            throttled = stub.throttled.get(method)
+            if throttled and throttled[0] > 0:
+                stub.throttled[method] = (throttled[0] - 1, throttled[1])
+            else:
+                throttled = None
+        if throttled:
+            self.send_json(429, {'ok': False, 'error': 'ratelimited'},
+                           headers={'Retry-After': str(throttled[1])})
+            return
+        handler = stub.methods.get(method)
+        if not handler:
+            self.send_json(200, {'ok': False, 'error': 'unknown_method'})
+            return
+        if stub.latency:
+            time.sleep(stub.latency)
+        self.send_json(200, handler(params))
+
+
+class StubSlackApi(StubServer):
+    """ Answers the Slack Web API methods used by the connector from an
+    in-memory directory of users. Point a WebClient at it with
+    `WebClient(token='xoxb-stub', base_url=stub.api_url)`.
+
+    `throttled` maps methods to (count, retry_after): the next `count`
+    calls of the method are answered with a 429 and a Retry-After header """
+    handler_class = StubSlackApiHandler
+
+    def __init__(self, users=(), domain='example', latency=0, throttled=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.users = list(users)
+        self.domain = domain
+        self.latency = latency
+        self.throttled = dict(throttled or {})
+        self.lock = threading.Lock()
+        self.calls = []
+        self.methods = {
+            'users.list': self.users_list,
+            'users.info': self.users_info,
+            'team.info': self.team_info,
+            'chat.getPermalink': self.chat_get_permalink,
+            'files.info': self.files_info,
+        }
+
+    @property
+    def api_url(self):
+        return self.url + 'api/'
+
+    def call_count(self, method):
+        return len([call for call in self.calls if call[0] == method])
+
+    def users_list(self, params):
+        start = int(params.get('cursor') or 0)
+        limit = int(params.get('limit') or 100)
+        members = self.users[start:start + limit]
+        next_cursor = (str(start + limit)
+                       if start + limit < len(self.users) else '')
+        return {'ok': True, 'members': members,
+                'response_metadata': {'next_cursor': next_cursor}}
+
+    def users_info(self, params):
+        for user in self.users:
+            if user.get('id') == params.get('user'):
+                return {'ok': True, 'user': user}
+        return {'ok': False, 'error': 'user_not_found'}
+
+    def team_info(self, params):
+        return {'ok': True, 'team': {'id': params.get('team'),
+                                     'domain': self.domain}}
+
+    def chat_get_permalink(self, params):
+        ts = (params.get('message_ts') or '').replace('.', '')
+        return {'ok': True, 'permalink': (
+            f'https://{self.domain}.slack.com/archives/'
+            f'{params.get("channel")}/p{ts}')}
+
+    def files_info(self, params):
+        return {'ok': True, 'file': {'id': params.get('file'), 'permalink': (
+            f'https://{self.domain}.slack.com/files/{params.get("file")}')}}
+
+
+def stub_slack_user(user_id, email=None, display_name=None, **fields):
+    """ Builds a Slack user object as returned by users.list/users.info """
+    user = {
+        'id': user_id,
+        'real_name': display_name or user_id,
+        'deleted': False,
+        'is_bot': False,
+        'profile': {'display_name': display_name or user_id},
+    }
+    if email:
+        user['profile']['email'] = email
+    user.update(fields)
+    return user
@@ -1,75 +1,471 @@
+from contextlib import contextmanager
+from datetime import timedelta
 import json
 import logging
+import random
 import requests
 import time
+import uuid
 
 from celery import shared_task
-from slack_events.models import SlackEvent, XApiStatement
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import (Count, DateTimeField, DurationField,
+                              ExpressionWrapper, F, Value)
+from django.utils import timezone
+
+from main import metrics
+from main.helper import get_or_none
+from main.query_budget import query_budget
+from slack_events.envelope import to_envelope
+from slack_events.raw_log import append_raw_events
+from slack_events.slack_api import (SlackRateLimited, parse_retry_after,
+                                    slack_client)
+from slack_events.spool import drain_spool
+from slack_events.models import SlackEvent, XApiStatement, XApiDelivery
+from xapi.actors import sync_slack_users
 from xapi.models import LrsConfig
+from xapi.sessions import get_lrs_session
 
 log = logging.getLogger(__name__)
 RETRIES = 6
 RETRY_INTERVAL = 10
+RETRY_MAX_INTERVAL = 600
 TIMEOUT=3
+FLUSH_SCHEDULED_KEY = 'lrs:flush:scheduled'
+# Most queries a stage of the event tasks may make (see main.query_budget).
+# The map stages leave room for loading the rules and creating a few actors,
+# the other batch stages do not grow with the size of the batch
+QUERY_BUDGETS = {
+    'save_event': 8,
+    'map_statement': 12,
+    'queue_deliveries': 4,
+    'buffer_deliveries': 1,
+    'batch_dedup': 1,
+    'batch_map': 25,
+    'batch_save': 12,
+    'save_trace': 1,
+}
+
+
+class RetriableDeliveryError(Exception):
+    """ The LRS could not take the statements right now (connection error,
+    429 or 5xx), the delivery should be tried again later """
+    def __init__(self, reason, retry_after=None):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+@contextmanager
+def pipeline_stage(stage, slack_events=()):
+    """ Times a stage of the event tasks, adds its duration to the traces of
+    `slack_events` and holds it to its query budget """
+    with metrics.timer('pipeline_stage_seconds', stage=stage) as timer, \
+            query_budget(stage, QUERY_BUDGETS[stage]):
+        yield
+    for slack_event in slack_events:
+        slack_event.record_stage(stage, timer.seconds)
+
+
+def start_trace(slack_event, trace, started_at):
+    """ Starts the trace of an event with the times passed on by the web
+    process (see ingress.queue_trace), if any """
+    trace = trace or {}
+    slack_event.start_trace(
+        received_at=trace.get('received_at', {}).get(
+            slack_event.envelope.event_id),
+        enqueued_at=trace.get('enqueued_at'), started_at=started_at)
+
+
+def requeue_rate_limited(task, payload, error, trace, log_raw=False):
+    """ Queues a task again for when Slack allows the rate limited method
+    again, instead of handling events without their actors """
+    log.warning(f'Slack API method {error.method} is rate limited, trying '
+                f'again in {error.retry_after:.0f}s')
+    metrics.increment('slack_events_requeued_total')
+    task.apply_async((payload,), {'log_raw': log_raw, 'trace': trace},
+                     countdown=error.retry_after)
 
 
 @shared_task
-def schedule_xapi_task(payload):
+def schedule_xapi_task(payload, log_raw=False, trace=None):
     """ Handle Slack Events Subscription Payload to xAPI conversion and
-    delivery to one (or multiple) LRS """
-    slack_event = SlackEvent(_payload=json.dumps(payload))
-    slack_event.save()
+    delivery to one (or multiple) LRS
 
-    xapi_statement = slack_event.slack_event_to_xapi_statement()
+    The payload is queued in its serialized form, so it is decoded once
+    here and shared with the SlackEvent instead of decoded per stage.
+    The webhook adds the events to the raw event log as they are received,
+    new events queued some other way are added to it with `log_raw` """
+    started_at = time.time()
+    slack_event = SlackEvent.from_envelope(to_envelope(payload))
+    start_trace(slack_event, trace, started_at)
+    try:
+        with pipeline_stage('save_event', [slack_event]), \
+                transaction.atomic():
+            slack_event.save()
+            if log_raw:
+                append_raw_events([slack_event.envelope.serialized])
+    except IntegrityError:
+        log.info(f'Event {slack_event.event_id} has already been processed')
+        metrics.increment('slack_events_duplicates_total')
+        return
+    metrics.increment('slack_events_saved_total')
+
+    try:
+        with pipeline_stage('map_statement', [slack_event]):
+            xapi_statement = slack_event.slack_event_to_xapi_statement()
+    except SlackRateLimited as error:
+        # Saved again together with its statement once Slack allows it
+        slack_event.delete()
+        requeue_rate_limited(schedule_xapi_task,
+                             slack_event.envelope.serialized, error, trace)
+        return
 
     if not xapi_statement:
         log.exception("xAPI Statement could not be generated")
         return
 
-    lrs_configs = LrsConfig.objects.all()
+    with pipeline_stage('queue_deliveries', [slack_event]):
+        lrs_configs = LrsConfig.objects.filter(is_active=True)
+        if not lrs_configs:
+            log.exception("No LRS defined yet. Cannot send xAPI statment")
+            return
+
+        statement = XApiStatement.objects.filter(
+            slack_event=slack_event).last()
+        XApiDelivery.objects.bulk_create([
+            XApiDelivery(statement=statement, lrs_config=lrs_config)
+            for lrs_config in lrs_configs])
+    if slack_event.trace is not None:
+        # The event was saved before the durations of its stages were known
+        with pipeline_stage('save_trace'):
+            SlackEvent.objects.filter(pk=slack_event.pk).update(
+                trace=slack_event.trace)
+    buffer_xapi_statement([lrs_config.pk for lrs_config in lrs_configs])
+
+
+@shared_task
+def schedule_xapi_batch_task(payloads, log_raw=False, trace=None):
+    """ Handles a batch of Slack Events Subscription Payloads like
+    schedule_xapi_task, but normalizes and maps them together and stores
+    the events, statements and deliveries with one bulk insert each in a
+    single transaction. The durations of the batch stages are added to the
+    trace of every event of the batch """
+    started_at = time.time()
+    slack_events = {}
+    for envelope in map(to_envelope, payloads):
+        if not envelope.event_id:
+            # Events without an id cannot be told apart after the insert
+            schedule_xapi_task(envelope, log_raw=log_raw, trace=trace)
+            continue
+        if envelope.event_id not in slack_events:
+            slack_event = SlackEvent.from_envelope(envelope)
+            start_trace(slack_event, trace, started_at)
+            slack_events[envelope.event_id] = slack_event
+
+    with pipeline_stage('batch_dedup', slack_events.values()):
+        existing_ids = set(SlackEvent.objects.filter(
+            event_id__in=list(slack_events)
+        ).values_list('event_id', flat=True))
+    for event_id in existing_ids:
+        log.info(f'Event {event_id} has already been processed')
+        del slack_events[event_id]
+    if existing_ids:
+        metrics.increment('slack_events_duplicates_total', len(existing_ids))
+    if not slack_events:
+        return
+
+    xapi_statements = {}
+    try:
+        with pipeline_stage('batch_map', slack_events.values()):
+            for event_id, slack_event in slack_events.items():
+                slack_event.populate_from_payload()
+                xapi_statement = slack_event.build_xapi_statement()
+                if xapi_statement:
+                    xapi_statements[event_id] = xapi_statement
+            lrs_configs = list(LrsConfig.objects.filter(is_active=True))
+    except SlackRateLimited as error:
+        # Nothing of the batch has been saved yet
+        requeue_rate_limited(
+            schedule_xapi_batch_task,
+            [slack_event.envelope.serialized
+             for slack_event in slack_events.values()],
+            error, trace, log_raw)
+        return
+
+    try:
+        with pipeline_stage('batch_save'), transaction.atomic():
+            save_xapi_batch(slack_events, xapi_statements, lrs_configs)
+            if log_raw:
+                append_raw_events([slack_event.envelope.serialized
+                                   for slack_event in slack_events.values()])
+    except IntegrityError:
+        # Some of the events were stored by another task in the meantime,
+        # the single event task skips those
+        log.info('Batch overlaps with processed events, handling the '
+                 'events one by one')
+        for slack_event in slack_events.values():
+            schedule_xapi_task(slack_event.envelope, log_raw=log_raw,
+                               trace=trace)
+        return
+    metrics.increment('slack_events_saved_total', len(slack_events))
+    metrics.increment('xapi_statements_saved_total', len(xapi_statements))
+
+    if len(xapi_statements) < len(slack_events):
+        log.info(f'{len(slack_events) - len(xapi_statements)} of '
+                 f'{len(slack_events)} events did not match a statement')
+    if xapi_statements and lrs_configs:
+        buffer_xapi_statement([lrs_config.pk for lrs_config in lrs_configs])
+
+
+def save_xapi_batch(slack_events, xapi_statements, lrs_configs):
+    """ Bulk inserts a batch of events, their statements and a delivery of
+    each statement to every LRS. Not every backend sets the primary keys on
+    bulk_create, so they are looked up again by the unique event_id """
+    SlackEvent.objects.bulk_create(slack_events.values())
+    slack_event_ids = dict(SlackEvent.objects.filter(
+        event_id__in=list(xapi_statements)).values_list('event_id', 'pk'))
+    XApiStatement.objects.bulk_create([
+        XApiStatement(statement=json.dumps(xapi_statement, default=str),
+                      slack_event_id=slack_event_ids[event_id])
+        for event_id, xapi_statement in xapi_statements.items()])
     if not lrs_configs:
-        log.exception("No LRS defined yet. Cannot send xAPI statment")
         return
 
-    for lrs_config in lrs_configs:
-        send_xapi_statement_to_lrs(lrs_config, xapi_statement, slack_event)
-    return
+    statement_ids = XApiStatement.objects.filter(
+        slack_event__in=list(slack_event_ids.values())
+    ).values_list('pk', flat=True)
+    XApiDelivery.objects.bulk_create([
+        XApiDelivery(statement_id=statement_id, lrs_config=lrs_config)
+        for statement_id in statement_ids for lrs_config in lrs_configs])
+
+
+def buffer_xapi_statement(lrs_config_ids):
+    """ Schedules the delivery of the pending xAPI deliveries, which act as
+    one delivery buffer per LRS. A buffer is flushed straight away once it
+    holds a full batch, otherwise after at most LRS_BATCH_MAX_AGE seconds """
+    with pipeline_stage('buffer_deliveries'):
+        pending = dict(
+            XApiDelivery.objects.filter(lrs_config__in=lrs_config_ids,
+                                        status='pending',
+                                        next_attempt_at__lte=timezone.now())
+            .values_list('lrs_config').annotate(Count('pk')))
+
+    for lrs_config_id in lrs_config_ids:
+        if pending.get(lrs_config_id, 0) >= settings.LRS_BATCH_SIZE:
+            flush_xapi_statements.delay(lrs_config_id)
+        elif cache.add(f'{FLUSH_SCHEDULED_KEY}:{lrs_config_id}', True,
+                       timeout=settings.LRS_BATCH_MAX_AGE):
+            flush_xapi_statements.apply_async(
+                (lrs_config_id,), countdown=settings.LRS_BATCH_MAX_AGE)
+
+
+@shared_task
+def flush_xapi_statements(lrs_config_id):
+    """ Hands the buffered xAPI statements of an LRS over to delivery in
+    batches of at most LRS_BATCH_SIZE. Each LRS is flushed and delivered to
+    by its own tasks, so a slow LRS does not hold up the others. Anything
+    beyond LRS_FLUSH_MAX_BATCHES is left to the next flush or sweep """
+    cache.delete(f'{FLUSH_SCHEDULED_KEY}:{lrs_config_id}')
+    lrs_config = get_or_none(LrsConfig, pk=lrs_config_id)
+    if not lrs_config or not lrs_config.is_active:
+        return
+
+    for _ in range(settings.LRS_FLUSH_MAX_BATCHES):
+        delivery_ids = claim_pending_deliveries(lrs_config)
+        if not delivery_ids:
+            return
+        deliver_xapi_statements.delay(lrs_config.pk, delivery_ids)
+        if len(delivery_ids) < settings.LRS_BATCH_SIZE:
+            return
+
+
+def claim_pending_deliveries(lrs_config):
+    """ Marks a batch of due pending deliveries to an LRS as sending so that
+    they are not picked up by another flush. SQLite ignores
+    select_for_update, so the update only claims deliveries that are still
+    pending and tags them with a token of this flush
 
+    Returns the ids of the claimed deliveries """
+    now = timezone.now()
+    claim = uuid.uuid4().hex
+    with transaction.atomic():
+        delivery_ids = list(
+            XApiDelivery.objects.select_for_update(skip_locked=True)
+            .filter(lrs_config=lrs_config, status='pending',
+                    next_attempt_at__lte=now)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:settings.LRS_BATCH_SIZE])
+        if not delivery_ids:
+            return []
+        claimed = XApiDelivery.objects.filter(
+            pk__in=delivery_ids, status='pending').update(
+                status='sending', claim=claim, next_attempt_at=now)
+    if claimed == len(delivery_ids):
+        return delivery_ids
+    # Another flush claimed some of them in between
+    return list(XApiDelivery.objects.filter(claim=claim)
+                .order_by('pk').values_list('pk', flat=True))
 
-def send_xapi_statement_to_lrs(lrs_config, xapi_statement, slack_event):
-    """ Sends an xAPI statement to an LRS """
-    if not lrs_config.is_active:
+
+@shared_task(bind=True, max_retries=RETRIES)
+def deliver_xapi_statements(self, lrs_config_id, delivery_ids):
+    """ Sends a batch of xAPI statements to an LRS. Failures the LRS may
+    recover from are retried as delayed tasks with exponential backoff
+    so the worker is not blocked while the LRS is unavailable. Once the
+    retries are used up the deliveries go back to the outbox to be picked
+    up by the sweeper """
+    deliveries = XApiDelivery.objects.filter(pk__in=delivery_ids,
+                                             status='sending')
+    lrs_config = get_or_none(LrsConfig, pk=lrs_config_id)
+    if not lrs_config or not lrs_config.is_active:
+        deliveries.update(status='pending')
+        return
+
+    xapi_statements = [
+        delivery.statement for delivery in
+        deliveries.select_related('statement').order_by('pk')]
+    if not xapi_statements:
+        return
+    deliveries.update(attempts=F('attempts') + 1)
+    try:
+        send_xapi_statements_to_lrs(lrs_config, xapi_statements)
+    except RetriableDeliveryError as error:
+        if self.request.retries >= self.max_retries:
+            log.exception(
+                f'Max retries exceeded, leaving xAPI statements to the '
+                f'sweeper. Reason: {str(error)}')
+            metrics.increment('lrs_deliveries_failed_total',
+                              len(xapi_statements),
+                              lrs=lrs_config.display_name,
+                              reason='max_retries')
+            deliveries.update(
+                status='pending', last_error=str(error),
+                next_attempt_at=timezone.now() + timedelta(
+                    seconds=settings.LRS_REDELIVERY_INTERVAL))
+            return
+        countdown = retry_countdown(self.request.retries, error.retry_after)
+        metrics.increment('lrs_delivery_retries_total',
+                          lrs=lrs_config.display_name)
+        log.warning(
+            f'Error sending xAPI statements to {lrs_config.lrs_endpoint}. '
+            f'{self.request.retries + 1} out of {RETRIES + 1} tries. '
+            f'Retrying in {countdown:.0f}s. Reason: {str(error)}')
+        deliveries.update(
+            last_error=str(error),
+            next_attempt_at=timezone.now() + timedelta(seconds=countdown))
+        raise self.retry(countdown=countdown)
+    except requests.exceptions.RequestException as error:
+        log.exception(f'xAPI statements rejected. Reason: {str(error)}')
+        metrics.increment('lrs_deliveries_failed_total',
+                          len(xapi_statements), lrs=lrs_config.display_name,
+                          reason='rejected')
+        deliveries.update(status='failed', last_error=str(error))
         return
 
-    headers = {'Content-type': 'application/json;charset=UTF-8',
-               'x-experience-api-version': '1.0.1'}
-    for retry in range(1, RETRIES+1):
-        try:
-            res = requests.post(lrs_config.lrs_endpoint,
-                                data=json.dumps(xapi_statement, default=str),
-                                auth=(lrs_config.lrs_auth_user,
-                                      lrs_config.get_password()),
-                                headers=headers,
-                                timeout=TIMEOUT)
-            if res.status_code == 200:
-                break
-
-            if retry == RETRIES:
-                log.exception(f'Max retries exceeded. Reason: {res.reason}')
-                return
-
-        except requests.exceptions.ConnectionError as connection_error:
-            if retry == RETRIES:
-                log.exception(
-                    f'Max retries exceeded. Reason: {str(connection_error)}')
-                return
-
-        log.exception(
-            f'Error sending xAPI statement to {lrs_config.lrs_endpoint}. '
-            f'{retry} out of {RETRIES} tries.')
-
-    xapi_statement = XApiStatement.objects.filter(slack_event=slack_event)
-    if xapi_statement:
-        xapi_statement.update(delivered=True)
-    log.info(f'Successfully sent xAPI statement to {lrs_config.lrs_endpoint}')
-    return
+    delivered_at = timezone.now()
+    deliveries.update(status='delivered', delivered_at=delivered_at,
+                      last_error=None)
+    if settings.SLACK_EVENT_TRACE_ENABLED:
+        # Every delivery moves the latency on, so it ends up as the time it
+        # took to reach the last LRS
+        SlackEvent.objects.filter(
+            pk__in={xapi_statement.slack_event_id
+                    for xapi_statement in xapi_statements},
+            received_at__isnull=False,
+        ).update(latency=ExpressionWrapper(
+            Value(delivered_at, output_field=DateTimeField())
+            - F('received_at'), output_field=DurationField()))
+    # A statement counts as delivered once every LRS has accepted it
+    XApiStatement.objects.filter(
+        pk__in=[statement.pk for statement in xapi_statements]
+    ).exclude(
+        deliveries__status__in=['pending', 'sending', 'failed']
+    ).update(delivered=True)
+
+
+@shared_task
+def sweep_xapi_deliveries():
+    """ Periodically re-queues the deliveries that are due but not in
+    flight, so every statement reaches every LRS at least once even if a
+    flush or delivery task was lost """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=settings.LRS_DELIVERY_STALE_AFTER)
+    stale_ids = list(
+        XApiDelivery.objects.filter(status='sending',
+                                    next_attempt_at__lt=stale_before)
+        .values_list('pk', flat=True)[:settings.LRS_SWEEP_BATCH_SIZE])
+    if stale_ids:
+        log.warning(f'Re-queueing {len(stale_ids)} stale xAPI deliveries')
+        XApiDelivery.objects.filter(pk__in=stale_ids).update(
+            status='pending', next_attempt_at=now)
+
+    lrs_config_ids = (
+        XApiDelivery.objects.filter(status='pending', next_attempt_at__lte=now,
+                                    lrs_config__is_active=True)
+        .order_by().values_list('lrs_config', flat=True).distinct())
+    for lrs_config_id in lrs_config_ids:
+        flush_xapi_statements.delay(lrs_config_id)
+
+
+def send_xapi_statements_to_lrs(lrs_config, xapi_statements):
+    """ Sends a batch of xAPI statements to an LRS in a single request
+
+    Raises RetriableDeliveryError if the request can be tried again and
+    requests.HTTPError if the LRS rejected the statements """
+    session = get_lrs_session(lrs_config)
+    data = json.dumps([xapi_statement.get_statement()
+                       for xapi_statement in xapi_statements], default=str)
+    lrs = lrs_config.display_name
+    try:
+        with metrics.timer('lrs_request_seconds', lrs=lrs):
+            res = session.post(lrs_config.lrs_endpoint, data=data,
+                               timeout=TIMEOUT)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout) as error:
+        metrics.increment('lrs_requests_total', lrs=lrs,
+                          status=type(error).__name__)
+        raise RetriableDeliveryError(str(error))
+    metrics.increment('lrs_requests_total', lrs=lrs, status=res.status_code)
+
+    if res.status_code == 429 or res.status_code >= 500:
+        raise RetriableDeliveryError(
+            f'{res.status_code} {res.reason}',
+            retry_after=parse_retry_after(res.headers, default=None))
+    res.raise_for_status()
+    metrics.increment('lrs_statements_delivered_total', len(xapi_statements),
+                      lrs=lrs)
+
+    log.info(f'Successfully sent {len(xapi_statements)} xAPI statements to '
+             f'{lrs_config.lrs_endpoint}')
+    return res
+
+
+def retry_countdown(retries, retry_after=None):
+    """ Exponential backoff with jitter, but never sooner than the LRS asked
+    for in its Retry-After header """
+    backoff = min(RETRY_INTERVAL * 2 ** retries, RETRY_MAX_INTERVAL)
+    countdown = backoff / 2 + random.uniform(0, backoff / 2)
+    if retry_after is not None:
+        countdown = max(countdown, retry_after)
+    return countdown
+
+
+@shared_task
+def drain_slack_spool():
+    """ Periodically queues the events spooled by the web processes while
+    the broker was unavailable """
+    drained = drain_spool(
+        schedule_xapi_batch_task.delay, settings.SLACK_SPOOL_DIR,
+        batch_size=settings.SLACK_INGRESS_BATCH_SIZE,
+        stale_after=settings.SLACK_SPOOL_STALE_AFTER)
+    if drained:
+        log.info(f'Queued {drained} spooled events')
+
+
+@shared_task
+def sync_slack_users_task():
+    """ Periodically creates/updates the actors of all workspace members """
+    created, updated = sync_slack_users(slack_client)
+    log.info(f'Created {created} and updated {updated} actors from Slack')
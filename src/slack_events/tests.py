@@ -1,10 +1,47 @@
+import asyncio
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from unittest.mock import Mock, patch
 
+from asgiref.testing import ApplicationCommunicator
+from django.core.cache import cache
 from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date
+import requests
+from slack import WebClient
+
+from main import metrics
+from main.helper import create_sha1
+from main.query_budget import QueryBudgetExceeded, query_budget
+from xapi.actors import actor_cache, sync_slack_users
+from xapi.rules import compile_rules
 
 from xapi.models import (XApiActor, XApiVerb, XApiObject, SlackVerbField,
-                         SlackObjectField)
-from .models import SlackEvent, XApiStatement
+                         SlackObjectField, LrsConfig)
+from . import helper, ingress, loadgen, slack_api
+from .asgi import WebhookRouter
+from .aggregator import IngressAggregator, IngressBufferFull
+from .benchmarks import compare_with_baselines
+from .envelope import SlackEventEnvelope
+from .ingress import recent_event_ids
+from .normalize import normalize_payloads
+from .spool import EventSpool, drain_spool
+from .models import RawSlackEvent, SlackEvent, XApiStatement, XApiDelivery
+from .raw_log import iter_raw_events, last_raw_event
+from .slack_api import SlackClient, SlackRateLimited, slack_client
+from .stubs import StubSlackApi, stub_slack_user
+from .tasks import (buffer_xapi_statement, claim_pending_deliveries,
+                    flush_xapi_statements, deliver_xapi_statements,
+                    sweep_xapi_deliveries, schedule_xapi_task,
+                    schedule_xapi_batch_task, retry_countdown, QUERY_BUDGETS,
+                    RETRIES)
 
 from django.contrib.auth.models import User
 
@@ -13,7 +50,19 @@ TEST_USER_PASSWORD = 'fakepassword'
 REAL_USER_ID = 'U01AP783ZLK'
 
 
-@override_settings(ENABLE_PERMALINKS=False)
+@contextmanager
+def stub_slack_client(*users):
+    """ Points the shared Slack client at a stub Slack API knowing `users`
+    for the duration of the block """
+    slack_api = StubSlackApi(users=users).start()
+    try:
+        with patch.object(slack_client, 'base_url', slack_api.api_url):
+            yield slack_api
+    finally:
+        slack_api.stop()
+
+
+@override_settings(ENABLE_PERMALINKS=False, QUERY_BUDGETS_ENFORCED=True)
 class SlackEventUnitTest(TestCase):
     def setUp(self):
         self.maxDiff = None
@@ -92,6 +141,180 @@ class SlackEventUnitTest(TestCase):
         xapi_statement = XApiStatement.objects.get(slack_event=slack_event)
         self.assertTrue(isinstance(xapi_statement, XApiStatement))
 
+    @override_settings(ENABLE_PERMALINKS=True)
+    @patch('slack_events.models.get_message_permalink')
+    def test_permalink_resolved_after_save(self, get_message_permalink):
+        permalink = 'https://example.slack.com/archives/C01/p1600285641000300'
+        get_message_permalink.return_value = permalink
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+
+        slack_event = SlackEvent(_payload=json.dumps(slack_event_payloads[0]))
+        slack_event.save()
+        get_message_permalink.assert_not_called()
+
+        xapi_statement = slack_event.slack_event_to_xapi_statement()
+        get_message_permalink.assert_called_once()
+        self.assertEqual(
+            xapi_statement['object']['definition']['extensions'][
+                'http://example.com/extensions/permalink'], permalink)
+        self.assertEqual(SlackEvent.objects.get(pk=slack_event.pk).permalink,
+                         permalink)
+
+    def test_envelope_decoded_once(self):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            body = json.dumps(json.load(file)[0]).encode('utf-8')
+
+        with patch('json.loads', wraps=json.loads) as loads:
+            envelope = SlackEventEnvelope.from_json(body)
+            slack_event = SlackEvent.from_envelope(envelope)
+            slack_event.save()
+            with patch('slack_events.helper.get_team_domain',
+                       return_value='example'):
+                permalink = helper.get_message_permalink(slack_event)
+        self.assertEqual(loads.call_count, 1)
+        self.assertIs(slack_event._payload, envelope.serialized)
+        self.assertEqual(slack_event.event_id, envelope.event_id)
+        self.assertTrue(permalink.startswith('https://example.slack.com/'))
+        with self.assertRaises(AttributeError):
+            envelope.event_type = 'message'
+
+    def test_normalize_payloads(self):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+
+        with self.assertNumQueries(0):
+            normalized = normalize_payloads(slack_event_payloads)
+        self.assertEqual(len(normalized), len(slack_event_payloads))
+        self.assertEqual(normalized[1]['event_type'], 'reaction_added')
+        self.assertEqual(normalized[1]['event_subtype'], 'message')
+
+        slack_event = SlackEvent(_payload=json.dumps(slack_event_payloads[2]))
+        slack_event.save()
+        for field, value in normalized[2].items():
+            self.assertEqual(getattr(slack_event, field), value)
+
+    @patch('slack_events.tasks.buffer_xapi_statement')
+    def test_schedule_xapi_batch_task(self, buffer_xapi_statement):
+        lrs_config = LrsConfig(
+            display_name='LRS',
+            lrs_endpoint='http://lrs.example.com/xapi/statements',
+            lrs_auth_user='user',
+            lrs_auth_pw='password'
+        )
+        lrs_config.save()
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+        with stub_slack_client():
+            schedule_xapi_task(slack_event_payloads[2])
+
+            schedule_xapi_batch_task(
+                [json.dumps(payload) for payload in slack_event_payloads]
+                + [slack_event_payloads[0]])
+
+        self.assertEqual(SlackEvent.objects.count(), 3)
+        statement = XApiStatement.objects.get(
+            slack_event__event_id=slack_event_payloads[0]['event_id'])
+        self.assertEqual(statement.get_statement()['verb']['id'],
+                         'http://example.com/verbs/sent')
+        self.assertEqual(XApiDelivery.objects.count(),
+                         XApiStatement.objects.count())
+        self.assertEqual(statement.deliveries.get().lrs_config, lrs_config)
+        buffer_xapi_statement.assert_called_with([lrs_config.pk])
+
+    def test_query_budgets(self):
+        LrsConfig.objects.create(
+            display_name='LRS',
+            lrs_endpoint='http://lrs.example.com/xapi/statements',
+            lrs_auth_user='user', lrs_auth_pw='password')
+        payloads = list(loadgen.generate_payloads(4, kinds=('message',)))
+        queries = {stage: metrics.get_counter('db_queries_total', stage=stage)
+                   for stage in QUERY_BUDGETS}
+
+        # A stage over its budget raises QueryBudgetExceeded in the tests
+        with patch('slack_events.tasks.flush_xapi_statements'):
+            schedule_xapi_task(payloads[0])
+            schedule_xapi_batch_task(payloads[1:])
+        for stage in QUERY_BUDGETS:
+            self.assertGreater(
+                metrics.get_counter('db_queries_total', stage=stage),
+                queries[stage], stage)
+
+        exceeded = metrics.get_counter('db_query_budget_exceeded_total',
+                                       stage='users')
+        with self.assertRaises(QueryBudgetExceeded):
+            with query_budget('users', 1):
+                User.objects.count()
+                User.objects.count()
+        with query_budget('users', 1, enforce=False) as budget:
+            User.objects.count()
+            User.objects.count()
+        self.assertEqual(budget.queries, 2)
+        self.assertEqual(
+            metrics.get_counter('db_query_budget_exceeded_total',
+                                stage='users'), exceeded + 2)
+
+    @patch('requests.Session.post')
+    def test_event_trace(self, post):
+        post.return_value = Mock(status_code=200)
+        lrs_config = LrsConfig.objects.create(
+            display_name='LRS',
+            lrs_endpoint='http://lrs.example.com/xapi/statements',
+            lrs_auth_user='user', lrs_auth_pw='password')
+        payload = next(loadgen.generate_payloads(1, kinds=('message',)))
+        envelope = SlackEventEnvelope.from_json(
+            payload, received_at=time.time() - 2)
+        with patch('slack_events.ingress.schedule_xapi_batch_task') as task:
+            ingress.publish_events([envelope])
+        trace = task.apply_async.call_args[0][1]['trace']
+
+        with patch('slack_events.tasks.flush_xapi_statements'):
+            schedule_xapi_batch_task([payload], trace=trace)
+        delivery = XApiDelivery.objects.get()
+        delivery.status = 'sending'
+        delivery.save()
+        deliver_xapi_statements.apply(args=(lrs_config.pk, [delivery.pk]))
+
+        slack_event = SlackEvent.objects.get()
+        self.assertAlmostEqual(slack_event.received_at.timestamp(),
+                               envelope.received_at, places=3)
+        self.assertGreaterEqual(slack_event.latency.total_seconds(), 2)
+        self.assertEqual(
+            set(slack_event.trace_durations()),
+            {'ingress', 'queue', 'batch_dedup', 'batch_map', 'actor'})
+
+        User.objects.create_superuser('admin', 'admin@example.com',
+                                      TEST_USER_PASSWORD)
+        self.client.login(username='admin', password=TEST_USER_PASSWORD)
+        response = self.client.get(
+            reverse('admin:slack_events_slackevent_changelist'))
+        self.assertContains(response, slack_event.event_id)
+        response = self.client.get(
+            reverse('admin:slack_events_slackevent_change',
+                    args=(slack_event.pk,)))
+        self.assertContains(response, 'delivery to LRS: ')
+
+    def test_raw_event_log(self):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            payloads = [json.dumps(payload) for payload in json.load(file)]
+        with stub_slack_client():
+            schedule_xapi_task(payloads[0], log_raw=True)
+            schedule_xapi_task(payloads[0], log_raw=True)
+            schedule_xapi_batch_task(payloads, log_raw=True)
+
+        self.assertEqual(RawSlackEvent.objects.count(), 2)
+        self.assertEqual(list(iter_raw_events()),
+                         [(1, payloads[0]), (2, payloads[1]),
+                          (3, payloads[2])])
+        self.assertEqual(list(iter_raw_events(after=1, until=2)),
+                         [(2, payloads[1])])
+        self.assertEqual(last_raw_event().event_id,
+                         json.loads(payloads[2])['event_id'])
+
+        with stub_slack_client():
+            schedule_xapi_batch_task(payloads)
+        self.assertEqual(RawSlackEvent.objects.count(), 2)
+
     def test_create_actor_from_slack(self):
         self.admin_user = User(username='admin',
                                password=TEST_USER_PASSWORD)
@@ -106,3 +329,684 @@ class SlackEventUnitTest(TestCase):
 
         self.assertTrue(isinstance(slack_event.create_actor_from_slack(),
                                    XApiActor))
+
+
+@override_settings(ENABLE_PERMALINKS=False, LRS_BATCH_SIZE=2)
+class XApiStatementDeliveryUnitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username=TEST_USERNAME,
+                                        password=TEST_USER_PASSWORD)
+        self.lrs_config = LrsConfig(
+            display_name='LRS',
+            lrs_endpoint='http://lrs.example.com/xapi/statements',
+            lrs_auth_user='user',
+            lrs_auth_pw='password'
+        )
+        self.lrs_config.save()
+
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+        self.deliveries = []
+        for payload in slack_event_payloads:
+            slack_event = SlackEvent(_payload=json.dumps(payload))
+            slack_event.save()
+            statement = XApiStatement.objects.create(
+                statement=json.dumps({'event_id': slack_event.event_id}),
+                slack_event=slack_event)
+            self.deliveries.append(XApiDelivery.objects.create(
+                statement=statement, lrs_config=self.lrs_config))
+
+    @patch('slack_events.tasks.deliver_xapi_statements.delay')
+    @patch('requests.Session.post')
+    def test_flush_xapi_statements(self, post, deliver):
+        post.return_value = Mock(status_code=200)
+        deliver.side_effect = (
+            lambda *args: deliver_xapi_statements.apply(args=args))
+
+        flush_xapi_statements(self.lrs_config.pk)
+
+        self.assertEqual(post.call_count, 2)
+        sent_statements = json.loads(post.call_args_list[0][1]['data'])
+        self.assertEqual(sent_statements, [
+            {'event_id': 'Ev01AMJETER4'}, {'event_id': 'Ev01BMNX530V'}])
+        self.assertFalse(
+            XApiStatement.objects.filter(delivered=False).exists())
+        self.assertFalse(
+            XApiDelivery.objects.exclude(status='delivered').exists())
+
+    def test_claim_pending_deliveries_once(self):
+        # Another flush claimed the second delivery after this one selected
+        # it, which SQLite does not prevent with select_for_update
+        first, second = self.deliveries[:2]
+        XApiDelivery.objects.filter(pk=second.pk).update(status='sending')
+        with patch.object(XApiDelivery.objects, 'select_for_update') as select:
+            select.return_value.filter.return_value.order_by.return_value \
+                .values_list.return_value = [first.pk, second.pk]
+            self.assertEqual(claim_pending_deliveries(self.lrs_config),
+                             [first.pk])
+        self.assertEqual(XApiDelivery.objects.get(pk=second.pk).claim, None)
+
+    @patch('slack_events.tasks.flush_xapi_statements')
+    def test_buffer_xapi_statement_per_lrs(self, flush):
+        other_lrs_config = LrsConfig(
+            display_name='Other LRS',
+            lrs_endpoint='http://other-lrs.example.com/xapi/statements',
+            lrs_auth_user='user',
+            lrs_auth_pw='password'
+        )
+        other_lrs_config.save()
+        XApiDelivery.objects.create(statement=self.deliveries[0].statement,
+                                    lrs_config=other_lrs_config)
+
+        buffer_xapi_statement([self.lrs_config.pk, other_lrs_config.pk])
+
+        flush.delay.assert_called_once_with(self.lrs_config.pk)
+        flush.apply_async.assert_called_once_with(
+            (other_lrs_config.pk,), countdown=5)
+
+    @patch('slack_events.tasks.flush_xapi_statements')
+    def test_buffer_xapi_statement_full_batch(self, flush):
+        buffer_xapi_statement([self.lrs_config.pk])
+        flush.delay.assert_called_once_with(self.lrs_config.pk)
+
+    @patch('requests.Session.post')
+    def test_deliver_xapi_statements_retries(self, post):
+        post.side_effect = [
+            Mock(status_code=503, reason='Service Unavailable',
+                 headers={'Retry-After': '120'}),
+            Mock(status_code=200),
+        ]
+        XApiDelivery.objects.filter(pk=self.deliveries[0].pk).update(
+            status='sending')
+
+        deliver_xapi_statements.apply(
+            args=(self.lrs_config.pk, [self.deliveries[0].pk]))
+
+        delivery = XApiDelivery.objects.get(pk=self.deliveries[0].pk)
+        self.assertEqual(delivery.status, 'delivered')
+        self.assertEqual(delivery.attempts, 2)
+
+    @patch('requests.Session.post')
+    def test_deliver_xapi_statements_rejected(self, post):
+        post.return_value = Mock(status_code=400)
+        post.return_value.raise_for_status.side_effect = requests.HTTPError()
+        XApiDelivery.objects.filter(pk=self.deliveries[0].pk).update(
+            status='sending')
+
+        deliver_xapi_statements.apply(
+            args=(self.lrs_config.pk, [self.deliveries[0].pk]))
+
+        self.assertEqual(post.call_count, 1)
+        delivery = XApiDelivery.objects.get(pk=self.deliveries[0].pk)
+        self.assertEqual(delivery.status, 'failed')
+
+    @override_settings(LRS_DELIVERY_STALE_AFTER=0)
+    @patch('slack_events.tasks.flush_xapi_statements')
+    def test_sweep_xapi_deliveries(self, flush):
+        XApiDelivery.objects.filter(pk=self.deliveries[0].pk).update(
+            status='sending')
+        XApiDelivery.objects.filter(pk=self.deliveries[1].pk).update(
+            status='delivered')
+
+        sweep_xapi_deliveries()
+
+        self.assertEqual(
+            XApiDelivery.objects.get(pk=self.deliveries[0].pk).status,
+            'pending')
+        flush.delay.assert_called_once_with(self.lrs_config.pk)
+
+    @patch('requests.Session.post')
+    def test_deliver_xapi_statements_max_retries(self, post):
+        post.side_effect = requests.exceptions.ConnectionError('refused')
+        XApiDelivery.objects.filter(pk=self.deliveries[0].pk).update(
+            status='sending')
+
+        deliver_xapi_statements.apply(
+            args=(self.lrs_config.pk, [self.deliveries[0].pk]))
+
+        delivery = XApiDelivery.objects.get(pk=self.deliveries[0].pk)
+        self.assertEqual(delivery.status, 'pending')
+        self.assertEqual(delivery.attempts, RETRIES + 1)
+        self.assertEqual(delivery.last_error, 'refused')
+        self.assertGreater(delivery.next_attempt_at, timezone.now())
+
+    def test_retry_countdown(self):
+        self.assertTrue(5 <= retry_countdown(0) <= 10)
+        self.assertTrue(20 <= retry_countdown(2) <= 40)
+        self.assertTrue(300 <= retry_countdown(20) <= 600)
+        self.assertEqual(retry_countdown(0, retry_after=120), 120)
+
+
+class SlackPermalinkUnitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        helper._team_domains.clear()
+
+    def test_build_message_permalink(self):
+        self.assertEqual(
+            helper.build_message_permalink(
+                'example', 'C01BCQGKR5E', '1600285641.000300'),
+            'https://example.slack.com/archives/C01BCQGKR5E/'
+            'p1600285641000300')
+        self.assertEqual(
+            helper.build_message_permalink(
+                'example', 'C01BCQGKR5E', '1600285641.000300',
+                thread_ts='1600285600.000100'),
+            'https://example.slack.com/archives/C01BCQGKR5E/'
+            'p1600285641000300?thread_ts=1600285600.000100&cid=C01BCQGKR5E')
+
+    @patch('slack_events.helper.slack_client')
+    def test_get_message_permalink_without_api_calls(self, slack_client):
+        slack_client.team_info.return_value = {
+            'ok': True, 'team': {'domain': 'example'}}
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+        slack_events = []
+        for payload in slack_event_payloads[:2]:
+            slack_event = SlackEvent(_payload=json.dumps(payload))
+            slack_event.save()
+            slack_events.append(slack_event)
+
+        self.assertEqual(
+            helper.get_message_permalink(slack_events[0]),
+            'https://example.slack.com/archives/C01BCQGKR5E/'
+            'p1600285641000300')
+        self.assertEqual(
+            helper.get_reaction_permalink(slack_events[1]),
+            'https://example.slack.com/archives/C01AG7LP57G/'
+            'p1601500903000300')
+        slack_client.team_info.assert_called_once_with(team='T01AV5ATPA8')
+        slack_client.chat_getPermalink.assert_not_called()
+
+
+@override_settings(ACTOR_IRI_TYPE='mbox_sha1sum')
+class SyncSlackUsersUnitTest(TestCase):
+    def setUp(self):
+        # Actors resolved by earlier tests must not leak into the sync
+        cache.clear()
+        actor_cache.clear()
+        self.admin_user = User.objects.create(username='admin',
+                                              password=TEST_USER_PASSWORD)
+        XApiActor.objects.create(
+            created_by=self.admin_user,
+            iri='outdated',
+            display_name='Outdated',
+            iri_type='mbox_sha1sum',
+            slack_user_id='U0'
+        )
+        XApiActor.objects.create(
+            created_by=self.admin_user,
+            iri='https://openid.example.com/user1',
+            display_name='OpenID user',
+            iri_type='openid',
+            slack_user_id='U1'
+        )
+        users = [stub_slack_user(f'U{index}', f'user{index}@example.com')
+                 for index in range(250)]
+        users.append(stub_slack_user('U250'))
+        users.append(stub_slack_user('B1', 'bot@example.com', is_bot=True))
+        self.slack_api = StubSlackApi(users=users).start()
+        self.slack_client = WebClient(token='xoxb-stub',
+                                      base_url=self.slack_api.api_url)
+
+    def tearDown(self):
+        self.slack_api.stop()
+
+    def test_sync_slack_users(self):
+        created, updated = sync_slack_users(self.slack_client, batch_size=100)
+
+        self.assertEqual((created, updated), (248, 1))
+        self.assertEqual(self.slack_api.call_count('users.list'), 2)
+        self.assertEqual(XApiActor.objects.count(), 250)
+        actor = XApiActor.objects.get(slack_user_id='U0')
+        self.assertEqual(actor.iri, create_sha1('user0@example.com'))
+        self.assertEqual(actor.display_name, 'U0')
+        # Actors configured by hand are not overwritten
+        actor = XApiActor.objects.get(slack_user_id='U1')
+        self.assertEqual(actor.iri, 'https://openid.example.com/user1')
+        self.assertEqual(actor.iri_type, 'openid')
+
+    @override_settings(SLACK_API_MAX_WAIT=0)
+    @patch.dict(slack_api.METHOD_TIERS, {'users.list': 1})
+    @patch('xapi.actors.time.sleep')
+    def test_sync_slack_users_rate_limited(self, sleep):
+        # The next window starts while the sync waits
+        sleep.side_effect = lambda seconds: cache.clear()
+        cache.clear()
+        slack_client = SlackClient(token='xoxb-stub',
+                                   base_url=self.slack_api.api_url)
+        created, updated = sync_slack_users(slack_client, batch_size=100)
+
+        self.assertEqual((created, updated), (248, 1))
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(self.slack_api.call_count('users.list'), 2)
+
+
+class SlackClientUnitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.slack_api = StubSlackApi(users=[stub_slack_user('U1')]).start()
+        self.slack_client = SlackClient(token='xoxb-stub',
+                                        base_url=self.slack_api.api_url)
+
+    def tearDown(self):
+        self.slack_api.stop()
+
+    @override_settings(SLACK_API_MAX_WAIT=0)
+    @patch.dict(slack_api.METHOD_TIERS, {'users.info': 1})
+    def test_rate_limit_budget(self):
+        self.assertTrue(self.slack_client.users_info(user='U1')['ok'])
+        with self.assertRaises(SlackRateLimited) as context:
+            self.slack_client.users_info(user='U1')
+        self.assertEqual(context.exception.method, 'users.info')
+        self.assertEqual(self.slack_api.call_count('users.info'), 1)
+
+    @override_settings(SLACK_API_MAX_WAIT=0)
+    def test_retry_after_shared(self):
+        self.slack_api.throttled['team.info'] = (1, 30)
+        with self.assertRaises(SlackRateLimited) as context:
+            self.slack_client.team_info(team='T1')
+        self.assertAlmostEqual(context.exception.retry_after, 30, places=0)
+
+        # Another process sharing the cache waits for the Retry-After too
+        other_client = SlackClient(token='xoxb-stub',
+                                   base_url=self.slack_api.api_url)
+        with self.assertRaises(SlackRateLimited):
+            other_client.team_info(team='T1')
+        self.assertEqual(self.slack_api.call_count('team.info'), 1)
+
+        with patch.object(helper, 'slack_client', other_client):
+            self.assertIsNone(helper.call_slack_api('team_info', team='T1'))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(slack_api.parse_retry_after({'retry-after': '5'}), 5)
+        retry_at = timezone.now() + timezone.timedelta(seconds=60)
+        self.assertAlmostEqual(slack_api.parse_retry_after(
+            {'Retry-After': http_date(retry_at.timestamp())}), 60, delta=2)
+        self.assertEqual(slack_api.parse_retry_after({'Retry-After': 'x'}),
+                         slack_api.DEFAULT_RETRY_AFTER)
+        self.assertIsNone(slack_api.parse_retry_after({}, default=None))
+
+    def test_retry_after_within_max_wait(self):
+        self.slack_api.throttled['team.info'] = (1, 0)
+        response = self.slack_client.team_info(team='T1')
+        self.assertEqual(response['team']['domain'], 'example')
+        self.assertEqual(self.slack_api.call_count('team.info'), 2)
+
+    def test_coalesce_identical_calls(self):
+        self.slack_api.latency = 0.2
+        responses = []
+        threads = [threading.Thread(target=lambda: responses.append(
+            self.slack_client.users_info(user='U1'))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(self.slack_api.call_count('users.info'), 1)
+        self.assertEqual({response['user']['id'] for response in responses},
+                         {'U1'})
+
+    @patch('slack_events.tasks.schedule_xapi_task.apply_async')
+    @patch.object(SlackEvent, 'slack_event_to_xapi_statement',
+                  side_effect=SlackRateLimited('users.info', 12))
+    def test_requeue_rate_limited_event(self, to_statement, apply_async):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            payload = json.dumps(json.load(file)[0])
+        schedule_xapi_task(payload)
+
+        self.assertFalse(SlackEvent.objects.exists())
+        apply_async.assert_called_once_with(
+            (payload,), {'log_raw': False, 'trace': None}, countdown=12)
+
+
+# The view writes the raw event log from other threads, which cannot see
+# the test transaction
+@override_settings(RAW_EVENT_LOG_ENABLED=False)
+class SlackXApiViewUnitTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        recent_event_ids.clear()
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            self.slack_event_payloads = json.load(file)
+        user = User.objects.create(username=TEST_USERNAME,
+                                   password=TEST_USER_PASSWORD)
+        xapi_verb = XApiVerb.objects.create(
+            created_by=user, iri='http://example.com/verbs/sent',
+            display_name='sent', language='en-US')
+        xapi_object = XApiObject.objects.create(
+            created_by=user, iri='http://example.com/activities/message',
+            display_name='Message', language='en-US')
+        SlackVerbField.objects.create(
+            created_by=user, slack_event_field='event_type',
+            expected_value='message', xapi_verb=xapi_verb,
+            field_group='sent_message')
+        SlackObjectField.objects.create(
+            created_by=user, slack_event_field='event_type',
+            expected_value='message', xapi_object=xapi_object,
+            field_group='sent_message')
+
+    def post_event(self, payload, **headers):
+        return self.client.post(reverse('xapi_slack'), json.dumps(payload),
+                                content_type='application/json', **headers)
+
+    @patch('slack_events.ingress.enqueue_event')
+    def test_webhook_router(self, enqueue_event):
+        # Compiled in the shared thread otherwise, which cannot see the
+        # rules of the test transaction
+        compile_rules()
+        django_application = Mock()
+        router = WebhookRouter(django_application, reverse('xapi_slack'))
+        body = json.dumps(self.slack_event_payloads[0]).encode('utf-8')
+
+        async def post():
+            communicator = ApplicationCommunicator(router, {
+                'type': 'http', 'method': 'POST',
+                'path': reverse('xapi_slack'),
+                'headers': [(b'X-Slack-Retry-Num', b'1')],
+            })
+            await communicator.send_input({'type': 'http.request',
+                                           'body': body})
+            start = await communicator.receive_output(timeout=5)
+            response = await communicator.receive_output(timeout=5)
+            return start['status'], json.loads(response['body'])
+
+        self.assertEqual(asyncio.run(post()), (200, {'ok': True}))
+        enqueue_event.assert_called_once()
+        django_application.assert_not_called()
+
+    @patch('slack_events.ingress.enqueue_event')
+    def test_slack_xapi_drops_retries(self, enqueue_event):
+        response = self.post_event(self.slack_event_payloads[0])
+        self.assertEqual(response.json(), {'ok': True})
+        response = self.post_event(self.slack_event_payloads[0],
+                                   HTTP_X_SLACK_RETRY_NUM='1')
+        self.assertEqual(response.json(), {'ok': True})
+        enqueue_event.assert_called_once()
+
+    @patch('slack_events.ingress.enqueue_event')
+    def test_slack_xapi_accepts_retry_after_failure(self, enqueue_event):
+        enqueue_event.side_effect = [OSError('Broker down'), None]
+        with self.assertRaises(OSError):
+            self.post_event(self.slack_event_payloads[0])
+        self.post_event(self.slack_event_payloads[0],
+                        HTTP_X_SLACK_RETRY_NUM='1')
+        self.assertEqual(enqueue_event.call_count, 2)
+
+    @override_settings(ACTOR_CREATION_ENABLED=True)
+    def test_schedule_xapi_task_duplicate_event(self):
+        User.objects.create(username='admin', password=TEST_USER_PASSWORD)
+        actor_cache.clear()
+        user_id = self.slack_event_payloads[0]['event']['user']
+        with stub_slack_client(
+                stub_slack_user(user_id, 'user@example.com')) as slack_api:
+            schedule_xapi_task(self.slack_event_payloads[0])
+            schedule_xapi_task(self.slack_event_payloads[0])
+        self.assertEqual(SlackEvent.objects.count(), 1)
+        self.assertEqual(slack_api.call_count('users.info'), 1)
+
+    @patch('slack_events.ingress.enqueue_event')
+    def test_slack_xapi_drops_unmappable_events(self, enqueue_event):
+        dropped = metrics.get_counter('slack_events_dropped_total',
+                                      event_type='reaction_added',
+                                      reason='no_matching_rule')
+        response = self.post_event(self.slack_event_payloads[1])
+        self.assertEqual(response.json(), {'ok': True})
+        enqueue_event.assert_not_called()
+        self.assertEqual(
+            metrics.get_counter('slack_events_dropped_total',
+                                event_type='reaction_added',
+                                reason='no_matching_rule'), dropped + 1)
+
+    @override_settings(RAW_EVENT_LOG_ENABLED=True,
+                       SLACK_INGRESS_BATCHING=False)
+    @patch('slack_events.ingress.enqueue_event')
+    def test_raw_event_log_before_prefilter(self, enqueue_event):
+        envelopes = [SlackEventEnvelope(payload)
+                     for payload in self.slack_event_payloads[:2]]
+        self.assertTrue(ingress.accept_event(envelopes[0]))
+        self.assertFalse(ingress.accept_event(envelopes[1]))
+        self.assertFalse(ingress.accept_event(envelopes[1]))
+
+        enqueue_event.assert_called_once_with(envelopes[0])
+        self.assertEqual([payload for _, payload in iter_raw_events()],
+                         [envelopes[0].serialized, envelopes[1].serialized])
+
+
+class IngressAggregatorUnitTest(TestCase):
+    def setUp(self):
+        self.published = []
+        self.aggregator = IngressAggregator(
+            self.published.append, max_events=2, max_delay=60,
+            max_pending=3)
+
+    def envelope(self, event_id):
+        return SlackEventEnvelope({'event_id': event_id, 'event': {}})
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 1
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(condition())
+
+    def test_publish_full_batch(self):
+        envelopes = [self.envelope(f'Ev{index}') for index in range(3)]
+        self.aggregator.publish = Mock(side_effect=self.published.append)
+        for envelope in envelopes:
+            self.aggregator.add(envelope)
+        self.wait_for(lambda: self.published == [envelopes[:2]])
+        # Published by the thread of the aggregator, not by add()
+        self.assertIsNot(self.aggregator.thread, threading.current_thread())
+
+        self.aggregator.flush()
+        self.assertEqual(self.published, [envelopes[:2], envelopes[2:]])
+
+    def test_publish_after_max_delay(self):
+        self.aggregator.max_delay = 0.01
+        self.aggregator.add(self.envelope('Ev0'))
+        self.wait_for(lambda: len(self.published) == 1)
+
+    def test_keep_batch_until_buffer_full(self):
+        # Published in the test thread only, so that a failed batch is put
+        # back before the next envelope is added
+        self.aggregator.start_thread = Mock()
+        self.aggregator.publish = Mock(side_effect=OSError('Broker down'))
+        for index in range(3):
+            self.aggregator.add(self.envelope(f'Ev{index}'))
+        self.aggregator.flush()
+        self.aggregator.publish.assert_called_once()
+        self.assertEqual(len(self.aggregator.pending), 3)
+        with self.assertRaises(IngressBufferFull):
+            self.aggregator.add(self.envelope('Ev3'))
+
+        self.aggregator.publish = self.published.append
+        self.aggregator.flush()
+        self.assertEqual([len(batch) for batch in self.published], [2, 1])
+
+
+class EventSpoolUnitTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        ingress._broker_retry_at = 0
+
+    def test_drain_spool(self):
+        spool = EventSpool(self.directory, segment_size=1024 * 1024,
+                           fsync_interval=0)
+        spool.append(['{"event_id": "Ev0"}', '{"event_id": "Ev1"}'])
+        published = []
+        self.assertEqual(drain_spool(published.append, self.directory,
+                                     batch_size=10, stale_after=60), 0)
+
+        spool.seal()
+        publish = Mock(side_effect=OSError('Broker down'))
+        drain_spool(publish, self.directory, batch_size=10, stale_after=60)
+        self.assertEqual(drain_spool(published.append, self.directory,
+                                     batch_size=1, stale_after=60), 2)
+        self.assertEqual(published, [['{"event_id": "Ev0"}'],
+                                     ['{"event_id": "Ev1"}']])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_spool_fsyncs_end_of_burst(self):
+        spool = EventSpool(self.directory, segment_size=1024 * 1024,
+                           fsync_interval=0.05)
+        with patch('os.fsync') as fsync:
+            spool.append(['{"event_id": "Ev0"}'])
+            spool.append(['{"event_id": "Ev1"}'])
+            self.assertEqual(fsync.call_count, 1)
+            time.sleep(0.2)
+            self.assertEqual(fsync.call_count, 2)
+        self.assertFalse(spool.unsynced)
+
+    def test_drain_open_segment_of_stopped_process(self):
+        spool = EventSpool(self.directory, segment_size=1024 * 1024,
+                           fsync_interval=0)
+        spool.append(['{"event_id": "Ev0"}'])
+        published = []
+        self.assertEqual(drain_spool(published.append, self.directory,
+                                     batch_size=10, stale_after=0), 0)
+
+        # The lock is released when the process is gone
+        spool.file.close()
+        self.assertEqual(drain_spool(published.append, self.directory,
+                                     batch_size=10, stale_after=0), 1)
+        self.assertEqual(published, [['{"event_id": "Ev0"}']])
+
+    @patch('slack_events.ingress.schedule_xapi_batch_task')
+    def test_publish_events_spools_without_broker(self, batch_task):
+        envelopes = [SlackEventEnvelope({'event_id': 'Ev0', 'event': {}})]
+        batch_task.apply_async.side_effect = OSError('Broker down')
+        with override_settings(SLACK_SPOOL_DIR=self.directory):
+            ingress.publish_events(envelopes)
+            ingress.publish_events(envelopes)
+            self.assertEqual(batch_task.apply_async.call_count, 1)
+
+            ingress._broker_retry_at = 0
+            batch_task.apply_async.side_effect = None
+            ingress.publish_events(envelopes)
+
+        spooled = []
+        drain_spool(spooled.extend, self.directory, batch_size=10,
+                    stale_after=60)
+        self.assertEqual(spooled, [envelopes[0].serialized] * 2)
+
+
+class MetricsUnitTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_histogram(self):
+        for seconds in (0.003, 0.2, 0.2, 30):
+            metrics.observe('test_seconds', seconds, stage='a "b"')
+        histogram = metrics.get_histogram('test_seconds', stage='a "b"')
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+        text = metrics.render({}, {('test_seconds', (('stage', 'a "b"'),)):
+                                   histogram})
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{stage="a \\"b\\"",le="0.25"} 3',
+                      text)
+        self.assertIn('test_seconds_bucket{stage="a \\"b\\"",le="+Inf"} 4',
+                      text)
+        self.assertIn('test_seconds_count{stage="a \\"b\\""} 4', text)
+
+    def test_metrics_of_all_processes(self):
+        other_process = {
+            'counters': [['test_events_total', {'result': 'ok'}, 5]],
+            'histograms': [['test_ack_seconds', {},
+                            metrics.Histogram((0.1, 1)).to_dict()]],
+        }
+        with open(os.path.join(self.directory, 'worker-1.json'), 'w') as file:
+            json.dump(other_process, file)
+        with open(os.path.join(self.directory, 'gone-2.json'), 'w') as file:
+            json.dump(other_process, file)
+        os.utime(os.path.join(self.directory, 'gone-2.json'), (0, 0))
+
+        with override_settings(METRICS_DIR=self.directory):
+            metrics.increment('test_events_total', 2, result='ok')
+            with metrics.timer('test_ack_seconds'):
+                pass
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode('utf-8')
+        process = os.path.basename(metrics.snapshot_path())[:-len('.json')]
+        total = metrics.get_counter('test_events_total', result='ok')
+        self.assertIn(f'test_events_total{{process="{process}",result="ok"}} '
+                      f'{total}\n', text)
+        self.assertIn('test_events_total{process="worker-1",result="ok"} 5\n',
+                      text)
+        self.assertIn(f'test_ack_seconds_count{{process="{process}"}} 1\n',
+                      text)
+        self.assertNotIn('gone-2', text)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+class LoadGeneratorUnitTest(TestCase):
+    def test_generate_payloads(self):
+        payloads = list(loadgen.generate_payloads(
+            8, kinds=('message', 'reaction', 'file_share', 'edit'),
+            run_id=1))
+        normalized = normalize_payloads(payloads)
+        self.assertEqual(len({event['event_id'] for event in normalized}), 8)
+        self.assertEqual(
+            [(event['event_type'], event['event_subtype'])
+             for event in normalized[:4]],
+            [('message', None), ('reaction_added', 'message'),
+             ('message', 'file_share'), ('message', 'message_changed')])
+        self.assertEqual(normalized[2]['file_ids'], ['F0LOAD'])
+
+    def test_run_load(self):
+        async def send(payload):
+            if json.loads(payload)['event_id'].endswith('1'):
+                raise loadgen.LoadError('HTTP 500')
+
+        payloads = list(loadgen.generate_payloads(4, run_id=1))
+        results = asyncio.get_event_loop().run_until_complete(
+            loadgen.run_load(send, payloads, concurrency=2))
+        summary = results.summary()
+        self.assertEqual(summary['sent'], 4)
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(results.errors['HTTP 500'], 1)
+        self.assertEqual(loadgen.find_event_ids(
+            {'object': {'id': f'http://example.com/{payloads[0]}'}}, 1),
+            [json.loads(payloads[0])['event_id']])
+
+    def test_run_load_counts_queueing(self):
+        async def send(payload):
+            await asyncio.sleep(0.05)
+
+        payloads = list(loadgen.generate_payloads(4, run_id=1))
+        results = asyncio.get_event_loop().run_until_complete(
+            loadgen.run_load(send, payloads, rate=1000, concurrency=1))
+        # The last event waited for the three before it
+        self.assertGreaterEqual(max(results.latencies), 0.15)
+
+    def test_compare_with_baselines(self):
+        baselines = {
+            'pipeline': {
+                'save events': {'per_second': 1000, 'queries': 500}},
+            'normalization': {
+                'models': {'per_second': 1000, 'speedup': 1},
+                'normalize': {'per_second': 3000, 'speedup': 3}}}
+        results = [{'name': 'save events', 'per_second': 900,
+                    'queries': 500}]
+        self.assertEqual(compare_with_baselines('pipeline', results,
+                                                baselines, 1.5), [])
+        # Only the queries count, the throughput depends on the machine
+        results[0].update(per_second=100, queries=501)
+        self.assertEqual(len(compare_with_baselines('pipeline', results,
+                                                    baselines, 1.5)), 1)
+
+        results = [{'name': 'models', 'per_second': 100, 'speedup': 1},
+                   {'name': 'normalize', 'per_second': 250, 'speedup': 2.5}]
+        self.assertEqual(compare_with_baselines('normalization', results,
+                                                baselines, 1.5), [])
+        results[1].update(per_second=150, speedup=1.5)
+        self.assertEqual(len(compare_with_baselines('normalization', results,
+                                                    baselines, 1.5)), 1)
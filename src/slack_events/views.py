@@ -1,37 +1,69 @@
-import json
 import logging
+import time
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.shortcuts import render
 from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
 
-from .models import RawSlackEvent, SlackEvent
-from .tasks import schedule_xapi_task
+from main import metrics
+from xapi import rules
+from .envelope import SlackEventEnvelope
+from .models import SlackEvent
+from .raw_log import last_raw_event
+from .ingress import accept_event
 
 log = logging.getLogger(__name__)
 
 
-@csrf_exempt
-def slack_xapi(request):
-    """ Slack Events API interface """
-    if not request.body:
-        return JsonResponse({'ok': False})
-    request_body = json.loads(request.body)
-    if request_body.get('type') == 'url_verification':
-        return JsonResponse({'challenge': request_body.get('challenge')})
+async def handle_webhook(body, retry_num=None):
+    """ Acknowledges a Slack Events API request, returns its JSON response
 
-    if not request_body.get('event'):
-        return JsonResponse({'ok': False})
-    schedule_xapi_task.delay(request_body)
-    return JsonResponse({'ok': True})
+    The checks only use the database to compile the rules, which is done
+    beforehand in the thread shared by Django's sync code if need be.
+    Otherwise they run in parallel in the threads of the executor, and the
+    batches are published by the aggregator's own thread (see
+    IngressAggregator) """
+    with metrics.timer('slack_webhook_ack_seconds'):
+        if not body:
+            return {'ok': False}
+        envelope = SlackEventEnvelope.from_json(body, received_at=time.time())
+        if envelope.payload.get('type') == 'url_verification':
+            return {'challenge': envelope.payload.get('challenge')}
+
+        if not envelope.event:
+            return {'ok': False}
+
+        if settings.SLACK_PREFILTER_ENABLED and not rules.are_compiled():
+            await sync_to_async(rules.compile_rules,
+                                thread_sensitive=True)()
+        accepted = await sync_to_async(accept_event, thread_sensitive=False)(
+            envelope, retry_num)
+        metrics.increment('slack_webhook_events_total',
+                          result='accepted' if accepted else 'dropped')
+        return {'ok': True}
+
+
+async def slack_xapi(request):
+    """ Slack Events API interface
+
+    Under ASGI the requests are answered by WebhookRouter instead, without
+    going through the middleware """
+    return JsonResponse(await handle_webhook(
+        request.body, request.headers.get('X-Slack-Retry-Num')))
+
+
+# csrf_exempt() of this Django version cannot wrap async views
+slack_xapi.csrf_exempt = True
 
 
 def statement_manager(request):
     """ UI configure xAPI statements """
-    raw_slack_event = RawSlackEvent.objects.last()
-    payload = dict(raw_slack_event.payload)
-    slack_event = SlackEvent(_payload=json.dumps(payload))
-    slack_event.save()
+    envelope = last_raw_event()
+    slack_event = None
+    if envelope:
+        slack_event = SlackEvent.from_envelope(envelope)
+        slack_event.populate_from_payload()
 
     return render(request, 'statement_manager.html', {
         'slack_event': slack_event,
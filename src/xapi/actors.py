@@ -0,0 +1,198 @@
+import logging
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from main import metrics
+from main.cache import TTLCache, bump_version
+from main.helper import get_or_none, create_sha1
+from slack_events.slack_api import SlackRateLimited
+
+log = logging.getLogger(__name__)
+ACTORS_VERSION_KEY = 'xapi:actors:version'
+ADMIN_USERNAME = 'admin'
+SLACK_USERS_PAGE_SIZE = 200
+SYNC_BATCH_SIZE = 500
+
+actor_cache = TTLCache(maxsize=settings.ACTOR_CACHE_SIZE,
+                       ttl=settings.ACTOR_CACHE_TTL,
+                       version_key=ACTORS_VERSION_KEY)
+
+
+class UnresolvableSlackUser(Exception):
+    """ Slack answered that a user cannot become an actor, e.g. because it
+    does not exist or has no email address """
+
+
+def resolve_actor(slack_user_id, create_actor=None):
+    """ Returns the XApiActor of a Slack user through the actor cache of
+    this process. Unknown users are looked up in the database and, if
+    `create_actor` is given, created through it.
+
+    Users that definitely cannot be resolved (`create_actor` raised
+    UnresolvableSlackUser, or there is no `create_actor` and no actor in
+    the database) are cached as None for ACTOR_NEGATIVE_CACHE_TTL seconds
+    so they are not queried again on every event. If `create_actor` merely
+    returns None, e.g. because Slack could not be reached, the user is
+    looked up again on the next event """
+    from .models import XApiActor
+
+    actor = actor_cache.get(slack_user_id)
+    if actor is not TTLCache.MISSING:
+        metrics.increment('actor_cache_requests_total',
+                          result='hit' if actor else 'negative_hit')
+        return actor
+    metrics.increment('actor_cache_requests_total', result='miss')
+
+    actor = get_or_none(XApiActor, slack_user_id=slack_user_id)
+    result = 'found'
+    # Saving an actor for the user invalidates the cache
+    unresolvable = create_actor is None
+    if not actor and create_actor:
+        result = 'created'
+        try:
+            actor = create_actor()
+        except UnresolvableSlackUser as error:
+            log.info(f'Slack user {slack_user_id} cannot be an actor: {error}')
+            unresolvable = True
+
+    if actor:
+        actor_cache.set(slack_user_id, actor)
+    else:
+        result = 'unresolved'
+        if unresolvable:
+            actor_cache.set(slack_user_id, None,
+                            ttl=settings.ACTOR_NEGATIVE_CACHE_TTL)
+    metrics.increment('actor_resolutions_total', result=result)
+    return actor
+
+
+def get_admin_user():
+    """ Returns the user automatically created actors are created by """
+    return get_or_none(User, username=ADMIN_USERNAME)
+
+
+def invalidate_actor(slack_user_id):
+    """ Drops an actor from the cache of this process and tells the other
+    processes sharing the Django cache to drop their cached actors """
+    actor_cache.delete(slack_user_id)
+    bump_version(ACTORS_VERSION_KEY)
+
+
+def actor_from_slack_user(user_data, admin_user):
+    """ Builds an (unsaved) XApiActor from a Slack user object as returned by
+    users.info or users.list, honouring ACTOR_IRI_TYPE
+
+    Returns None if the user has no email address """
+    from .models import XApiActor, ACTOR_IRI_TYPES
+
+    email = user_data.get('profile', {}).get('email')
+    if not email:
+        log.warning("No email in Slack user found")
+        return
+
+    if settings.ACTOR_IRI_TYPE not in [t[0] for t in ACTOR_IRI_TYPES]:
+        log.warning("Iri type declared is invalid")
+        return
+
+    if settings.ACTOR_IRI_TYPE == 'mbox_sha1sum':
+        email = create_sha1(email)
+
+    return XApiActor(
+        created_by=admin_user,
+        slack_user_id=user_data.get('id'),
+        iri=email,
+        iri_type=settings.ACTOR_IRI_TYPE,
+        display_name=(
+            user_data.get('profile', {}).get('display_name')
+            or user_data.get('real_name'))
+    )
+
+
+def iter_slack_users(slack_client, page_size=SLACK_USERS_PAGE_SIZE):
+    """ Pages through the members of the workspace with users.list. Unlike
+    the event tasks this is not in a hurry, so when users.list is rate
+    limited it waits for as long as Slack asks and goes on from the same
+    page """
+    cursor = None
+    while True:
+        try:
+            response = slack_client.users_list(limit=page_size, cursor=cursor)
+        except SlackRateLimited as error:
+            log.info(f'Waiting {error.retry_after:.0f}s for the next page of '
+                     f'Slack users')
+            time.sleep(error.retry_after)
+            continue
+        if not response.get('ok'):
+            log.exception(response.get('error'))
+            return
+        yield from response.get('members', [])
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+def save_actor_batch(actors):
+    """ Inserts the new and updates the changed actors of a batch with one
+    query each. Only actors that could have been created automatically
+    (by the admin user with the configured ACTOR_IRI_TYPE) are updated, the
+    actors configured by hand (e.g. with OpenID) are left as they are
+
+    Returns a tuple with the number of created and updated actors """
+    from .models import XApiActor
+
+    existing = {
+        actor.slack_user_id: actor for actor in XApiActor.objects.filter(
+            slack_user_id__in=[actor.slack_user_id for actor in actors])}
+    new_actors, changed_actors = [], []
+    for actor in actors:
+        existing_actor = existing.get(actor.slack_user_id)
+        if not existing_actor:
+            new_actors.append(actor)
+            continue
+        if (existing_actor.created_by_id != actor.created_by_id
+                or existing_actor.iri_type != actor.iri_type):
+            continue
+        if ((existing_actor.iri, existing_actor.display_name)
+                != (actor.iri, actor.display_name)):
+            existing_actor.iri = actor.iri
+            existing_actor.display_name = actor.display_name
+            changed_actors.append(existing_actor)
+    XApiActor.objects.bulk_create(new_actors)
+    XApiActor.objects.bulk_update(changed_actors, ['iri', 'display_name'])
+    return len(new_actors), len(changed_actors)
+
+
+def sync_slack_users(slack_client, batch_size=SYNC_BATCH_SIZE):
+    """ Creates or updates the XApiActors of all human members of the
+    workspace, so that events rarely need to look up users in Slack
+
+    Returns a tuple with the number of created and updated actors """
+    admin_user = get_admin_user()
+    if not admin_user:
+        log.warning("Admin user for automatic actor creation not found")
+        return 0, 0
+
+    created = updated = 0
+    batch = []
+    for user_data in iter_slack_users(slack_client):
+        if (user_data.get('deleted') or user_data.get('is_bot')
+                or user_data.get('id') == 'USLACKBOT'):
+            continue
+        actor = actor_from_slack_user(user_data, admin_user)
+        if not actor:
+            continue
+        batch.append(actor)
+        if len(batch) >= batch_size:
+            batch_created, batch_updated = save_actor_batch(batch)
+            created, updated = created + batch_created, updated + batch_updated
+            batch = []
+    if batch:
+        batch_created, batch_updated = save_actor_batch(batch)
+        created, updated = created + batch_created, updated + batch_updated
+
+    # Bulk operations do not send signals, drop the cached actors explicitly
+    actor_cache.clear()
+    bump_version(ACTORS_VERSION_KEY)
+    return created, updated
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class XapiConfig(AppConfig):
     name = 'xapi'
+
+    def ready(self):
+        from . import signals  # noqa: F401
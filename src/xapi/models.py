@@ -6,8 +6,9 @@ from django.contrib.auth.models import User
 
 from jsonfield import JSONField
 
-from main.helper import get_or_none
 from main.encrypt_decrypt import encrypt, decrypt
+from .actors import resolve_actor
+from .rules import get_matcher, to_expected_value
 
 ACTOR_IRI_TYPES = [
     ('account', 'Account'),
@@ -85,9 +86,10 @@ class XApiActor(models.Model):
         """ Converts the actor information from a Slack Event to an actor
         partial xAPI statement """
         prefix = ''
-        actor = get_or_none(XApiActor, slack_user_id=event.user_id)
+        actor = resolve_actor(event.user_id,
+                              create_actor=event.create_new_actor_from_slack)
         if not actor:
-            actor = event.create_actor_from_slack()
+            return None
 
         actor_statement = {
             'actor': {
@@ -152,14 +154,13 @@ class XApiObject(models.Model):
         return f'{self.display_name} ({self.language})'
 
     def model_to_xapi_object(self, event):
-        _id = ''
-        if not self.iri[-1] == '\/':
-            self.iri = self.iri + '/'
+        # Objects are cached by the rule matcher so the iri is not modified
+        iri = self.iri if self.iri.endswith('/') else self.iri + '/'
 
         if self.id_field == 'file_ids':
-            _id = f'{self.iri}{event.file_ids[0]}'
+            _id = f'{iri}{event.file_ids[0]}'
         else:
-            _id = f'{self.iri}{getattr(event, self.id_field) or event.event_id}'
+            _id = f'{iri}{getattr(event, self.id_field) or event.event_id}'
 
         if settings.ENABLE_PERMALINKS and self.id_field == 'permalink':
             if event.permalink:
@@ -196,7 +197,8 @@ class XApiObject(models.Model):
                 extension_value = getattr(event, extension)
                 xapi_object['object']['definition']['extensions'][extension_key] = extension_value  # noqa: E501
 
-        if settings.ENABLE_PERMALINKS and event.permalink:
+        if (settings.ENABLE_PERMALINKS and settings.ENABLE_PERMALINK_EXTENSION
+                and event.permalink):
             xapi_object['object']['definition'].setdefault('extensions', {})
             xapi_object['object']['definition']['extensions'][
                 'http://example.com/extensions/permalink'] = event.permalink
@@ -208,38 +210,30 @@ class XApiObject(models.Model):
 
         for field in fields_for_object:
             object_dict.setdefault(field.field_group, {})
-            expected_value = field.expected_value
-            if field.expected_value == 'None':
-                expected_value = None
-            if (field.expected_value == 'True'
-                    or field.expected_value == 'False'):
-                expected_value = field.expected_value == 'True'
+            expected_value = to_expected_value(field.expected_value)
             object_dict[field.field_group][field.slack_event_field] = expected_value  # noqa: E501
         if not object_dict:
             return None
         return object_dict
 
+    def uses_permalink(self):
+        """ Whether the object built for an event contains its permalink """
+        if not settings.ENABLE_PERMALINKS:
+            return False
+        return (self.id_field == 'permalink'
+                or settings.ENABLE_PERMALINK_EXTENSION)
+
+    @staticmethod
+    def match_slack_event(slack_event):
+        """ Returns the first XApiObject whose fields match the event """
+        return get_matcher('object').match(slack_event)
+
     @staticmethod
     def slack_event_to_xapi_object(slack_event):
-        for xobject in XApiObject.objects.all():
-            object_fieldset = xobject.object_fields_to_dict()
-            if not object_fieldset:
-                continue
-            event = slack_event.__dict__
-            # Removing JSON fields because they cannot be converted to a set
-            if '_payload' in event:
-                del event['_payload']
-            if 'mentioned_users' in event:
-                del event['mentioned_users']
-            if 'attachments' in event:
-                del event['attachments']
-            if 'file_ids' in event:
-                del event['file_ids']
-            for fields in object_fieldset.values():
-                object_set = set(fields.items())
-                if object_set.issubset(set(slack_event.__dict__.items())):
-                    return xobject.model_to_xapi_object(slack_event)
-        return
+        xobject = XApiObject.match_slack_event(slack_event)
+        if not xobject:
+            return
+        return xobject.model_to_xapi_object(slack_event)
 
     class Meta:
         verbose_name = 'XApi Object'
@@ -265,12 +259,7 @@ class XApiVerb(models.Model):
         fields_for_verb = SlackVerbField.objects.filter(xapi_verb=self)
         for field in fields_for_verb:
             verb_dict.setdefault(field.field_group, {})
-            expected_value = field.expected_value
-            if field.expected_value == 'None':
-                expected_value = None
-            if (field.expected_value == 'True'
-                    or field.expected_value == 'False'):
-                expected_value = field.expected_value == 'True'
+            expected_value = to_expected_value(field.expected_value)
             verb_dict[field.field_group][field.slack_event_field] = expected_value  # noqa: E501
         return verb_dict
 
@@ -286,25 +275,10 @@ class XApiVerb(models.Model):
 
     @staticmethod
     def slack_event_to_xapi_verb(slack_event):
-        for verb in XApiVerb.objects.all():
-            verb_fieldset = verb.verb_fields_to_dict()
-            if not verb_fieldset:
-                continue
-            event = slack_event.__dict__
-            # Removing JSON fields because they cannot be converted to a set
-            if '_payload' in event:
-                del event['_payload']
-            if 'mentioned_users' in event:
-                del event['mentioned_users']
-            if 'attachments' in event:
-                del event['attachments']
-            if 'file_ids' in event:
-                del event['file_ids']
-            for fields in verb_fieldset.values():
-                verb_set = set(fields.items())
-                if verb_set.issubset(set(slack_event.__dict__.items())):
-                    return verb.model_to_xapi_verb()
-        return
+        verb = get_matcher('verb').match(slack_event)
+        if not verb:
+            return
+        return verb.model_to_xapi_verb()
 
     class Meta:
         verbose_name = 'XApi Verb'
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from main.cache import get_version, bump_version
+
+log = logging.getLogger(__name__)
+
+# Shared cache key bumped whenever a rule table changes so that every worker
+# process (not only the one that received the signal) recompiles its matcher
+RULES_VERSION_KEY = 'xapi:rules:version'
+# Rules are indexed by the value of this field, other fields are compared
+DISCRIMINATING_FIELD = 'event_type'
+SUBTYPE_FIELD = 'event_subtype'
+ANY = object()
+
+_lock = threading.Lock()
+_matchers = {}
+
+
+def to_expected_value(expected_value):
+    """ Converts the expected value of a SlackField (which is always stored
+    as a string) to the Python value it is compared against """
+    if expected_value == 'None':
+        return None
+    if expected_value == 'True' or expected_value == 'False':
+        return expected_value == 'True'
+    return expected_value
+
+
+class CompiledRule:
+    """ A single field group of a verb or object with its conditions
+    pre-typed, ready to be compared against a Slack Event """
+    __slots__ = ('priority', 'target', 'conditions')
+
+    def __init__(self, priority, target, conditions):
+        self.priority = priority
+        self.target = target
+        self.conditions = conditions
+
+    def matches(self, slack_event):
+        for field, expected_value in self.conditions:
+            if getattr(slack_event, field, ANY) != expected_value:
+                return False
+        return True
+
+
+class RuleMatcher:
+    """ Matches Slack Events against the compiled field groups of all
+    verbs or objects without touching the database.
+
+    The rules are kept in the order in which the original per-event queries
+    evaluated them so that the first match is the same one as before. """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.index = {}
+        self.wildcard = []
+
+        for rule in rules:
+            discriminator = dict(rule.conditions).get(
+                DISCRIMINATING_FIELD, ANY)
+            if discriminator is ANY:
+                self.wildcard.append(rule)
+            else:
+                self.index.setdefault(discriminator, []).append(rule)
+
+        # Merge the rules without a discriminating field into each bucket
+        # once here instead of on every lookup
+        for discriminator, bucket in self.index.items():
+            self.index[discriminator] = sorted(
+                bucket + self.wildcard, key=lambda rule: rule.priority)
+
+        # The subtypes the rules of each bucket expect, used to prefilter
+        # events before they are normalized
+        self.wildcard_subtypes = self.expected_subtypes(self.wildcard)
+        self.subtypes = {
+            discriminator: self.expected_subtypes(bucket)
+            for discriminator, bucket in self.index.items()}
+
+    @staticmethod
+    def expected_subtypes(rules):
+        return frozenset(dict(rule.conditions).get(SUBTYPE_FIELD, ANY)
+                         for rule in rules)
+
+    @classmethod
+    def compile(cls, targets, fields, target_attr):
+        """ Builds a matcher from the verbs/objects and their SlackFields
+
+        `targets` is an iterable of XApiVerb or XApiObject instances and
+        `fields` the SlackVerbFields or SlackObjectFields belonging to them,
+        linked through `target_attr` """
+        groups_by_target = {}
+        for field in fields:
+            groups = groups_by_target.setdefault(
+                getattr(field, target_attr), {})
+            groups.setdefault(field.field_group, {})
+            groups[field.field_group][field.slack_event_field] = (
+                to_expected_value(field.expected_value))
+
+        rules = []
+        for target in targets:
+            for conditions in groups_by_target.get(target.pk, {}).values():
+                rules.append(CompiledRule(
+                    priority=len(rules),
+                    target=target,
+                    conditions=tuple(conditions.items())))
+        return cls(rules)
+
+    def candidates(self, slack_event):
+        discriminator = getattr(slack_event, DISCRIMINATING_FIELD, None)
+        return self.index.get(discriminator, self.wildcard)
+
+    def match(self, slack_event):
+        """ Returns the verb/object of the first rule matching the event """
+        for rule in self.candidates(slack_event):
+            if rule.matches(slack_event):
+                return rule.target
+        return None
+
+    def can_match(self, event_type, event_subtype):
+        """ Checks cheaply if any rule could match an event of this type and
+        subtype, without looking at the other fields of the event """
+        subtypes = self.subtypes.get(event_type, self.wildcard_subtypes)
+        return ANY in subtypes or event_subtype in subtypes
+
+
+def _compile_verbs():
+    from .models import XApiVerb, SlackVerbField
+    return RuleMatcher.compile(
+        targets=XApiVerb.objects.all(),
+        fields=SlackVerbField.objects.all(),
+        target_attr='xapi_verb_id')
+
+
+def _compile_objects():
+    from .models import XApiObject, SlackObjectField
+    return RuleMatcher.compile(
+        targets=XApiObject.objects.all(),
+        fields=SlackObjectField.objects.all(),
+        target_attr='xapi_object_id')
+
+
+COMPILERS = {
+    'verb': _compile_verbs,
+    'object': _compile_objects,
+}
+
+
+def get_matcher(kind):
+    """ Returns the compiled matcher for either `verb` or `object` rules,
+    compiling it first if the rule tables changed since the last call or it
+    is older than XAPI_RULES_TTL (for processes that do not share a cache
+    with the one the rules were changed in) """
+    version = get_version(RULES_VERSION_KEY)
+    matcher = _matchers.get(kind)
+    if is_current(matcher, version):
+        return matcher[2]
+
+    with _lock:
+        matcher = _matchers.get(kind)
+        if is_current(matcher, version):
+            return matcher[2]
+        log.info(f'Compiling xAPI {kind} rules (version {version})')
+        compiled = COMPILERS[kind]()
+        _matchers[kind] = (version, time.monotonic(), compiled)
+        return compiled
+
+
+def are_compiled():
+    """ Checks without touching the database if get_matcher can return the
+    matchers of both kinds without compiling them """
+    version = get_version(RULES_VERSION_KEY)
+    return all(is_current(_matchers.get(kind), version) for kind in COMPILERS)
+
+
+def compile_rules():
+    for kind in COMPILERS:
+        get_matcher(kind)
+
+
+def is_current(matcher, version):
+    return (matcher is not None and matcher[0] == version
+            and time.monotonic() - matcher[1] < settings.XAPI_RULES_TTL)
+
+
+def invalidate_rules():
+    """ Drops the compiled matchers of this process, and once the rule change
+    is committed signals all other processes sharing the cache to recompile
+    theirs. Bumping the version before the commit would let them compile
+    the rules as they were before the change under the new version """
+    _matchers.clear()
+    transaction.on_commit(publish_rule_change)
+
+
+def publish_rule_change():
+    # Threads of this process may have compiled the uncommitted rules
+    _matchers.clear()
+    bump_version(RULES_VERSION_KEY)
@@ -0,0 +1,65 @@
+import base64
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+XAPI_VERSION = '1.0.1'
+POOL_MAXSIZE = 10
+
+_lock = threading.Lock()
+_sessions = {}
+
+
+def basic_auth_header(username, password):
+    credentials = f'{username}:{password}'.encode('utf-8')
+    return 'Basic ' + base64.b64encode(credentials).decode('latin-1')
+
+
+def config_fingerprint(lrs_config):
+    """ The encrypted password gets a new IV on every save, so any change to
+    the config row also changes its fingerprint """
+    return (lrs_config.lrs_endpoint, lrs_config.lrs_auth_user,
+            lrs_config.lrs_auth_pw)
+
+
+def create_lrs_session(lrs_config):
+    """ Creates a keep-alive session with the xAPI and auth headers of an
+    LRS already set, so the password is only decrypted once """
+    session = requests.Session()
+    session.headers.update({
+        'Content-type': 'application/json;charset=UTF-8',
+        'x-experience-api-version': XAPI_VERSION,
+        'Authorization': basic_auth_header(lrs_config.lrs_auth_user,
+                                           lrs_config.get_password()),
+    })
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_lrs_session(lrs_config):
+    """ Returns the pooled session of this worker for an LrsConfig, creating
+    a new one if the config has changed since the session was created """
+    fingerprint = config_fingerprint(lrs_config)
+    entry = _sessions.get(lrs_config.pk)
+    if entry and entry[0] == fingerprint:
+        return entry[1]
+
+    with _lock:
+        entry = _sessions.get(lrs_config.pk)
+        if entry and entry[0] == fingerprint:
+            return entry[1]
+        if entry:
+            entry[1].close()
+        session = create_lrs_session(lrs_config)
+        _sessions[lrs_config.pk] = (fingerprint, session)
+        return session
+
+
+def close_lrs_session(lrs_config_id):
+    with _lock:
+        entry = _sessions.pop(lrs_config_id, None)
+    if entry:
+        entry[1].close()
@@ -0,0 +1,35 @@
+from django.db.models.signals import post_save, post_delete
+
+from .actors import invalidate_actor
+from .models import (XApiVerb, XApiObject, SlackVerbField, SlackObjectField,
+                     LrsConfig, XApiActor)
+from .rules import invalidate_rules
+from .sessions import close_lrs_session
+
+RULE_MODELS = (XApiVerb, XApiObject, SlackVerbField, SlackObjectField)
+
+
+def invalidate_compiled_rules(sender, **kwargs):
+    """ Recompile the verb/object matchers whenever a rule table changes """
+    invalidate_rules()
+
+
+def close_changed_lrs_session(sender, instance, **kwargs):
+    """ Drop the pooled session of an LRS whose config changed """
+    close_lrs_session(instance.pk)
+
+
+def invalidate_changed_actor(sender, instance, **kwargs):
+    """ Drop cached actors when an actor is edited, e.g. in the admin """
+    invalidate_actor(instance.slack_user_id)
+
+
+for rule_model in RULE_MODELS:
+    post_save.connect(invalidate_compiled_rules, sender=rule_model)
+    post_delete.connect(invalidate_compiled_rules, sender=rule_model)
+
+post_save.connect(close_changed_lrs_session, sender=LrsConfig)
+post_delete.connect(close_changed_lrs_session, sender=LrsConfig)
+
+post_save.connect(invalidate_changed_actor, sender=XApiActor)
+post_delete.connect(invalidate_changed_actor, sender=XApiActor)
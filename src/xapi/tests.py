@@ -1,9 +1,15 @@
 import json
+from unittest.mock import Mock
 
 from django.test import TestCase, override_settings
 
+from main.cache import get_version
+
 from xapi.models import (XApiActor, XApiVerb, XApiObject, SlackVerbField,
-                         SlackObjectField)
+                         SlackObjectField, LrsConfig)
+from xapi.actors import actor_cache, resolve_actor, UnresolvableSlackUser
+from xapi.rules import RULES_VERSION_KEY, get_matcher
+from xapi.sessions import get_lrs_session
 from slack_events.models import SlackEvent
 from django.contrib.auth.models import User
 
@@ -274,3 +280,127 @@ class XApiConversionUnitTest(TestCase):
         slack_event.save()
         self.assertTrue(isinstance(slack_event.slack_event_to_xapi_statement(),
                                    dict))
+
+    def test_slack_event_to_xapi_verb_without_queries(self):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+        slack_event = SlackEvent(_payload=json.dumps(slack_event_payloads[0]))
+        slack_event.save()
+
+        XApiVerb.slack_event_to_xapi_verb(slack_event)
+        XApiObject.slack_event_to_xapi_object(slack_event)
+        with self.assertNumQueries(0):
+            self.assertTrue(XApiVerb.slack_event_to_xapi_verb(slack_event))
+            self.assertTrue(
+                XApiObject.slack_event_to_xapi_object(slack_event))
+
+    def test_slack_event_to_xapi_verb_after_rule_change(self):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+        slack_event = SlackEvent(_payload=json.dumps(slack_event_payloads[1]))
+        slack_event.save()
+        self.assertIsNone(XApiVerb.slack_event_to_xapi_verb(slack_event))
+
+        SlackVerbField.objects.create(
+            created_by=self.user,
+            slack_event_field='event_type',
+            expected_value='reaction_added',
+            xapi_verb=self.xapi_verb,
+            field_group='reaction_added'
+        )
+        self.assertTrue(XApiVerb.slack_event_to_xapi_verb(slack_event))
+
+    def test_slack_event_to_xapi_verb_after_rules_ttl(self):
+        with open('slack_events/test_data/slack_event_tests.json') as file:
+            slack_event_payloads = json.load(file)
+        slack_event = SlackEvent(_payload=json.dumps(slack_event_payloads[1]))
+        slack_event.save()
+        self.assertIsNone(XApiVerb.slack_event_to_xapi_verb(slack_event))
+
+        # The version is only bumped once the rule change is committed
+        version = get_version(RULES_VERSION_KEY)
+        SlackVerbField.objects.create(
+            created_by=self.user,
+            slack_event_field='event_type',
+            expected_value='reaction',
+            xapi_verb=self.xapi_verb,
+            field_group='reaction_added'
+        )
+        self.assertEqual(get_version(RULES_VERSION_KEY), version)
+        self.assertIsNone(XApiVerb.slack_event_to_xapi_verb(slack_event))
+
+        # A change made without signals, like one of another process not
+        # sharing the cache, is picked up once the compiled rules expire
+        SlackVerbField.objects.filter(expected_value='reaction').update(
+            expected_value='reaction_added')
+        self.assertIsNone(XApiVerb.slack_event_to_xapi_verb(slack_event))
+        with override_settings(XAPI_RULES_TTL=0):
+            self.assertTrue(XApiVerb.slack_event_to_xapi_verb(slack_event))
+
+    def test_rule_matcher_can_match(self):
+        verb_matcher = get_matcher('verb')
+        object_matcher = get_matcher('object')
+        self.assertTrue(verb_matcher.can_match('message', None))
+        self.assertFalse(verb_matcher.can_match('message', 'bot_message'))
+        self.assertFalse(verb_matcher.can_match('user_change', None))
+        self.assertTrue(object_matcher.can_match('message', 'message_changed'))
+        self.assertTrue(object_matcher.can_match('file_shared', None))
+
+
+class LrsSessionUnitTest(TestCase):
+    def test_get_lrs_session(self):
+        lrs_config = LrsConfig(
+            display_name='LRS',
+            lrs_endpoint='http://lrs.example.com/xapi/statements',
+            lrs_auth_user='user',
+            lrs_auth_pw='password'
+        )
+        lrs_config.save()
+
+        session = get_lrs_session(lrs_config)
+        self.assertIs(get_lrs_session(lrs_config), session)
+        self.assertEqual(session.headers['Authorization'],
+                         'Basic dXNlcjpwYXNzd29yZA==')
+
+        lrs_config.lrs_auth_pw = 'new_password'
+        lrs_config.save()
+        self.assertIsNot(get_lrs_session(lrs_config), session)
+
+
+class ActorCacheUnitTest(TestCase):
+    def setUp(self):
+        actor_cache.clear()
+        self.user = User.objects.create(username=TEST_USERNAME,
+                                        password=TEST_USER_PASSWORD)
+        self.actor = XApiActor.objects.create(
+            iri='actor1@example.com',
+            iri_type='mbox',
+            display_name='Actor 1',
+            slack_user_id='U123456',
+            created_by=self.user,
+        )
+
+    def test_resolve_actor_cached(self):
+        self.assertEqual(resolve_actor('U123456'), self.actor)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_actor('U123456'), self.actor)
+
+    def test_resolve_actor_negative_cache(self):
+        create_actor = Mock(side_effect=UnresolvableSlackUser)
+        self.assertIsNone(resolve_actor('U000000', create_actor))
+        with self.assertNumQueries(0):
+            self.assertIsNone(resolve_actor('U000000', create_actor))
+        create_actor.assert_called_once()
+
+    def test_resolve_actor_after_failed_creation(self):
+        # e.g. Slack could not be reached
+        create_actor = Mock(return_value=None)
+        self.assertIsNone(resolve_actor('U000000', create_actor))
+        self.assertIsNone(resolve_actor('U000000', create_actor))
+        self.assertEqual(create_actor.call_count, 2)
+
+    def test_resolve_actor_after_edit(self):
+        self.assertIsNone(resolve_actor('U000000'))
+        self.actor.slack_user_id = 'U000000'
+        self.actor.save()
+        self.assertEqual(resolve_actor('U000000'), self.actor)